@@ -1,96 +1,182 @@
 import datetime
+import heapq
 import math
+import os
 import random
+import threading
+import time
+import ujson
+from collections import namedtuple
 
 from subs.miniscape import quests, slayer, craft
-from subs.miniscape.files import ADVENTURES_FILE
-
-# An adventure in the adventure file is stored as the following (with semicolon delimiters in between):
-# adventureid, userid, completion_time, *args
-# where *args represent adventure-specific arguments.
+from subs.miniscape.files import ADVENTURES_FILE, LEGACY_ADVENTURES_FILE
+
+# An adventure in the adventure file is stored as one JSON object per line:
+# {"adventureid": 1, "userid": "1234", "finish_time": 1530000000, "args": [...]}
+# where finish_time is in seconds since the epoch and args are the adventure-specific arguments, in the order of the
+# fields of that kind of adventure's tuple in KINDS. With EAGER_RESULTS, there is also a "result" holding what was
+# rolled for the adventure when it started, which its completion handler is given instead of rolling again.
+# A user may also have a queue of up to QUEUE_CAP adventures to start, one after another, once their current one has
+# finished. It is stored as {"userid": "1234", "queue": [[adventureid, length in seconds, args, result], ...]}.
+# The file is a log: a later line for a user replaces their earlier one (or earlier queue), and a line of
+# {"userid": ..., "removed": true} ends their adventure. Adventures are held in memory keyed by userid, and only new
+# lines are appended to the file, which is rewritten without the replaced lines once it has grown to more than twice
+# the size it needs to be.
 
 ON_ADVENTURE_ERROR = 'You are currently in the middle of something. Please finish that before starting something else.'
 
-
-def add(adventure_id, userid, *args):
-    """Adds an adventure to a file."""
-    args_str = [str(arg) for arg in args]
-    out = f'{adventure_id};{userid};$TIME;'
-    out += f"{';'.join(args_str)}\n"
-    write(out)
-
-
-def add_finish_time(userid, time):
-    """Adds a datetime to a previously added adventure."""
-    adventures = [adventure.replace('$TIME', time) for adventure in get_list() if str(userid) in adventure]
-    write('\n'.join(adventures), overwrite=True)
-
-
-def format_line(*args):
-    args_str = [str(arg) for arg in args]
-    return ';'.join(args_str) + '\n'
+SLAYER_TASK = 0
+KILL = 1
+QUEST = 2
+GATHER = 3
+
+Adventure = namedtuple('Adventure', ['adventureid', 'userid', 'finish_time', 'args', 'result'], defaults=(None,))
+SlayerTask = namedtuple('SlayerTask', ['monsterid', 'monster_name', 'num_to_kill', 'chance'])
+Kill = namedtuple('Kill', ['monsterid', 'monster_name', 'number', 'length'])
+Quest = namedtuple('Quest', ['questid', 'chance'])
+Gather = namedtuple('Gather', ['itemid', 'item_name', 'number', 'length'])
+
+# The tuple each kind of adventure's args are stored in, and the type of each arg.
+KINDS = {
+    SLAYER_TASK: (SlayerTask, (int, str, int, int)),
+    KILL: (Kill, (int, str, int, int)),
+    QUEST: (Quest, (int, int)),
+    GATHER: (Gather, (int, str, int, int)),
+}
+
+Queued = namedtuple('Queued', ['adventureid', 'length', 'args', 'result'])
+
+COMPACT_EVERY = 1000    # The fewest lines the file can have before it is rewritten.
+QUEUE_CAP = 3           # The most adventures a user can have waiting to start after their current one.
+
+_REGISTRY = {'adventures': None, 'queues': {}, 'lines': 0}
+
+# Finish times of current adventures, as a heap of (finish_time, userid) entries. Entries are not removed when an
+# adventure is cancelled or replaced; instead an entry only counts if the user's adventure still has that finish time,
+# so stale ones are dropped as they reach the top.
+_SCHEDULE = []
+_LISTENERS = []
+
+# Every user's adventure is in the same registry and file, so functions that change them hold this lock to keep
+# commands for different users from overwriting each other's changes.
+_FILE_LOCK = threading.RLock()
+
+
+def add(adventureid, userid, finish_time, *args, result=None):
+    """Starts an adventure for a user, replacing any they already have."""
+    adventure = make_adventure(adventureid, userid, finish_time, args, result=result)
+    with _FILE_LOCK:
+        _load()[adventure.userid] = adventure
+        _schedule(adventure)
+        _append([adventure_to_record(adventure)])
+
+
+def add_listener(callback):
+    """Registers a function to be called with no arguments whenever an adventure is added that finishes before any
+    other. It may be called from any thread."""
+    _LISTENERS.append(callback)
+
+
+def adventure_to_record(adventure):
+    """Converts an adventure to the dictionary it is stored as in the adventures file."""
+    record = {'adventureid': adventure.adventureid, 'userid': adventure.userid, 'finish_time': adventure.finish_time,
+              'args': list(adventure.args)}
+    if adventure.result is not None:
+        record['result'] = adventure.result
+    return record
+
+
+def convert_legacy(source=LEGACY_ADVENTURES_FILE, destination=ADVENTURES_FILE):
+    """Converts an adventures file from the old adventureid;userid;finish time;args... format, where the finish time
+    is a local datetime string, to JSON lines, and returns the number of adventures converted. As in the new format, a
+    later line for a user replaces their earlier one, and x;userid removes their adventure. Adventures that were never
+    given a finish time are left out."""
+    adventures = {}
+    with open(source, 'r') as f:
+        for line in f.read().splitlines():
+            if not line:
+                continue
+            adventureid, userid, *rest = line.split(';')
+            if adventureid == 'x':
+                adventures.pop(userid, None)
+                continue
+            finish_time, *args = rest
+            try:
+                finish_time = datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+            except ValueError:
+                continue
+            adventures[userid] = make_adventure(int(adventureid), userid, math.ceil(finish_time), args)
+    _atomic_write_lines(destination, [adventure_to_record(adventure) for adventure in adventures.values()])
+    return len(adventures)
 
 
 def get_adventure(userid):
-    lines = get_list()
-    for line in lines:
-        if str(userid) in line:
-            return line.split(';')
-    else:
+    try:
+        return _load()[str(userid)]
+    except KeyError:
         raise NameError
 
 
+def get_queue(userid):
+    """Gets the adventures a user has queued after their current one, as a list of Queued."""
+    with _FILE_LOCK:
+        _load()
+        return list(_REGISTRY['queues'].get(str(userid), []))
+
+
 def get_delta(finish_time):
     """Calculates the time remaining until a task is finished in minutes."""
-    try:
-        finish_time = datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S.%f')
-    except ValueError:
-        raise ValueError
-    current_time = datetime.datetime.now()
-    delta = finish_time - current_time
-    return math.floor(delta.total_seconds() / 60)
+    return math.floor((finish_time - time.time()) / 60)
 
 
 def get_finish_time(task_length):
-    """Calculates the time when an adventure is over given its length."""
-    return datetime.datetime.now() + datetime.timedelta(seconds=task_length)
+    """Calculates the time when an adventure is over given its length, in seconds since the epoch."""
+    return math.ceil(time.time() + task_length)
 
 
 def get_finished():
     """Gets a list of adventureswith time preceding the current time, removes those from the adventure file,
     and returns the list of finished adventures."""
-    adventures = get_list()
-    finished_adventures = []
-    current_time = datetime.datetime.now()
-    out = ''
-    for adventure in adventures:
-        adventure_args = adventure.split(';')
-        time = adventure_args[2]
-        finish_time = datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S.%f')
-        if finish_time < current_time:
-            finished_adventures.append(adventure_args)
-        else:
-            out += f'{adventure}\n'
-    write(out, overwrite=True)
+    with _FILE_LOCK:
+        adventures = _load()
+        finished_adventures = []
+        current_time = time.time()
+        while _SCHEDULE and _SCHEDULE[0][0] < current_time:
+            finish_time, userid = heapq.heappop(_SCHEDULE)
+            if _is_scheduled(adventures, finish_time, userid):
+                finished_adventures.append(adventures.pop(userid))
+        _append([{'userid': adventure.userid, 'removed': True} for adventure in finished_adventures])
+        for adventure in finished_adventures:
+            _start_next(adventure.userid)
     return finished_adventures
 
 
 def get_list():
-    """Opens the adventures file and returns a list of adventures."""
-    with open(ADVENTURES_FILE, 'r') as f:
-        lines = f.read().splitlines()
-    return lines
+    """Returns a list of current adventures."""
+    with _FILE_LOCK:
+        return list(_load().values())
+
+
+def get_seconds_until_next():
+    """Gets the number of seconds until the next adventure finishes, or None if no adventures are running."""
+    with _FILE_LOCK:
+        adventures = _load()
+        while _SCHEDULE and not _is_scheduled(adventures, *_SCHEDULE[0]):
+            heapq.heappop(_SCHEDULE)
+        if not _SCHEDULE:
+            return None
+        return _SCHEDULE[0][0] - time.time()
 
 
 def is_on_adventure(userid):
     """Determines whether a user is already on/is preparing for an adventure."""
-    adventures = get_list()
+    return str(userid) in _load()
 
-    for adventure in adventures:
-        if str(userid) in adventure:
-            return True
-    else:
-        return False
+
+def is_queue_full(userid):
+    """Determines whether a user is on an adventure and cannot queue any more after it."""
+    userid = str(userid)
+    return userid in _load() and len(_REGISTRY['queues'].get(userid, ())) >= QUEUE_CAP
 
 
 def is_success(chance):
@@ -101,55 +187,176 @@ def is_success(chance):
         return False
 
 
-def print_adventure(userid):
-    lines = get_list()
+def make_adventure(adventureid, userid, finish_time, args, result=None):
+    """Creates an adventure, converting its args to the types for that kind of adventure."""
+    adventureid = int(adventureid)
+    kind, types = KINDS[adventureid]
+    args = kind(*[arg_type(arg) for arg_type, arg in zip(types, args)])
+    return Adventure(adventureid, str(userid), finish_time, args, result)
 
-    for line in lines:
-        if str(userid) in line:
-            adventure = line.split(';')
-            break
-    else:
-        raise KeyError
-    adventureid, userid, finish_time = adventure[0:3]
+
+def print_adventure(userid):
+    # Built only from read() and queue_length(), so that stateclient.install() makes this use the server's adventures.
+    adventure = read(userid)
     adventures = {
-        '0': slayer.print_status,
-        '1': slayer.print_kill_status,
-        '2': quests.print_status,
-        '3': craft.print_status
+        SLAYER_TASK: slayer.print_status,
+        KILL: slayer.print_kill_status,
+        QUEST: quests.print_status,
+        GATHER: craft.print_status
     }
-    time_left = get_delta(finish_time)
-    out = adventures[adventureid](time_left, adventure[3:])
+    time_left = get_delta(adventure.finish_time)
+    out = adventures[adventure.adventureid](time_left, adventure.args)
+    queued = queue_length(userid)
+    if queued > 0:
+        out += f'You have {queued} more queued after this. '
+    return out
+
+
+def print_queued(position):
+    """Prints a string saying where in the user's queue an adventure was put."""
+    out = f'It is number {position} in your queue, and will start once everything before it has finished.'
     return out
 
 
 def print_on_adventure_error(adventure):
-    """Prints a string saying that the user cannot do two adventures at once."""
-    out = f'Please finish that first before starting a new {adventure}.'
+    """Prints a string saying that the user cannot queue any more adventures."""
+    out = f'Your queue is full, so please finish that first before starting a new {adventure}.'
     return out
 
 
-def read(userid):
-    """Finds an adventure from a userid and returns the values of the adventure as a list."""
-    userid = str(userid)
-    adventures = get_list()
+def queue_length(userid):
+    """Gets the number of adventures a user has queued after their current one."""
+    with _FILE_LOCK:
+        _load()
+        return len(_REGISTRY['queues'].get(str(userid), ()))
 
-    for adventure in adventures:
-        if userid in adventure:
-            return adventure.split(';')
-    else:
+
+def read(userid):
+    """Finds an adventure from a userid and returns it."""
+    try:
+        return _load()[str(userid)]
+    except KeyError:
         raise ValueError
 
 
 def remove(userid):
-    """Removes an adventure from the adventures file containing the userid."""
+    """Removes a user's adventure, if they have one, along with any they have queued. Queued quests never started,
+    so the items they took are given back, once the adventures are no longer locked."""
     userid = str(userid)
-    new_adventures = [adventure for adventure in get_list() if userid not in adventure]
-    write('\n'.join(new_adventures) + '\n', overwrite=True)
-
-
-def write(data, overwrite=False):
-    """Writes/Appends a string representing adventures to the adventure file."""
-    operation = 'w+' if overwrite else 'a+'
-
-    with open(ADVENTURES_FILE, operation) as f:
-        f.write(data)
+    with _FILE_LOCK:
+        records = []
+        if _load().pop(userid, None) is not None:
+            records.append({'userid': userid, 'removed': True})
+        queue = _REGISTRY['queues'].pop(userid, [])
+        if queue:
+            records.append({'userid': userid, 'queue': []})
+        _append(records)
+    for queued in queue:
+        if queued.adventureid == QUEST:
+            quests.refund_items(userid, queued.args[0])
+
+
+def start(adventureid, userid, length, *args, result=None):
+    """Starts an adventure lasting length seconds, or if the user is already on one, queues it to start once the
+    adventures before it have finished. Returns the adventure's position in the queue, which is 0 if it has started.
+    Callers should check is_queue_full() first; a ValueError is raised if the queue is full."""
+    userid = str(userid)
+    with _FILE_LOCK:
+        if userid not in _load():
+            add(adventureid, userid, get_finish_time(length), *args, result=result)
+            return 0
+        queue = _REGISTRY['queues'].setdefault(userid, [])
+        if len(queue) >= QUEUE_CAP:
+            raise ValueError(f'{userid} already has {QUEUE_CAP} adventures queued.')
+        make_adventure(adventureid, userid, 0, args)
+        queue.append(Queued(int(adventureid), length, list(args), result))
+        _append([_queue_to_record(userid)])
+        return len(queue)
+
+
+def _append(records):
+    """Appends records to the adventures file, and rewrites it if enough of it is out of date."""
+    if not records:
+        return
+    with open(ADVENTURES_FILE, 'a') as f:
+        f.write(''.join(f'{ujson.dumps(record)}\n' for record in records))
+    _REGISTRY['lines'] += len(records)
+    if _REGISTRY['lines'] > max(COMPACT_EVERY, 2 * (len(_REGISTRY['adventures']) + len(_REGISTRY['queues']))):
+        _compact()
+
+
+def _atomic_write_lines(path, records):
+    """Replaces a file with one JSON record per line, so that it is never left half written."""
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(''.join(f'{ujson.dumps(record)}\n' for record in records))
+    os.replace(f'{path}.tmp', path)
+
+
+def _compact():
+    """Rewrites the adventures file with one line for each current adventure and queue."""
+    records = [adventure_to_record(adventure) for adventure in _REGISTRY['adventures'].values()]
+    records.extend(_queue_to_record(userid) for userid in _REGISTRY['queues'])
+    _atomic_write_lines(ADVENTURES_FILE, records)
+    _REGISTRY['lines'] = len(records)
+
+
+def _is_scheduled(adventures, finish_time, userid):
+    """Determines whether an entry in the schedule is for a user's current adventure."""
+    return userid in adventures and adventures[userid].finish_time == finish_time
+
+
+def _load():
+    """Gets the current adventures keyed by userid, reading them from the adventures file the first time. An
+    adventures file in the old format is converted first."""
+    with _FILE_LOCK:
+        if _REGISTRY['adventures'] is None:
+            if not os.path.exists(ADVENTURES_FILE) and os.path.exists(LEGACY_ADVENTURES_FILE):
+                convert_legacy()
+            adventures = {}
+            queues = {}
+            lines = 0
+            if os.path.exists(ADVENTURES_FILE):
+                with open(ADVENTURES_FILE, 'r') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        record = ujson.loads(line)
+                        lines += 1
+                        if record.get('removed'):
+                            adventures.pop(record['userid'], None)
+                        elif 'queue' in record:
+                            queues[record['userid']] = [Queued(*queued) for queued in record['queue']]
+                        else:
+                            adventures[record['userid']] = make_adventure(**record)
+            _REGISTRY['adventures'] = adventures
+            _REGISTRY['queues'] = {userid: queue for userid, queue in queues.items() if queue}
+            _REGISTRY['lines'] = lines
+            _SCHEDULE.clear()
+            for adventure in adventures.values():
+                _schedule(adventure, notify=False)
+        return _REGISTRY['adventures']
+
+
+def _schedule(adventure, notify=True):
+    """Adds an adventure's finish time to the schedule, and tells the listeners if it is now the first to finish."""
+    heapq.heappush(_SCHEDULE, (adventure.finish_time, adventure.userid))
+    if notify and _SCHEDULE[0][1] == adventure.userid:
+        for callback in _LISTENERS:
+            callback()
+
+
+def _queue_to_record(userid):
+    """Converts a user's queue to the dictionary it is stored as in the adventures file."""
+    return {'userid': userid, 'queue': [list(queued) for queued in _REGISTRY['queues'].get(userid, [])]}
+
+
+def _start_next(userid):
+    """Starts the first adventure in a user's queue, if they have one queued."""
+    queue = _REGISTRY['queues'].get(userid)
+    if not queue:
+        return
+    queued = queue.pop(0)
+    if not queue:
+        del _REGISTRY['queues'][userid]
+    _append([_queue_to_record(userid)])
+    add(queued.adventureid, userid, get_finish_time(queued.length), *queued.args, result=queued.result)
@@ -0,0 +1,28 @@
+"""Times decoding and encoding the accounts file in each format, and reading an inventory from the decoded accounts.
+
+Run from the bot's root directory:
+    python -m subs.miniscape.bench.codecs [accounts] [items per account]"""
+import sys
+
+from subs.miniscape import userstore
+from subs.miniscape.bench.shards import best_of, make_accounts
+from subs.miniscape.inventory import Inventory
+
+
+def main(number=5000, items=120):
+    accounts = make_accounts(number, items)
+    for codec, (decode, encode) in userstore.CODECS.items():
+        try:
+            data = encode(accounts)
+        except ImportError as e:
+            print(f'{codec}: skipped ({e})')
+            continue
+        decoded = decode(data)
+        first = next(iter(decoded.values()))['items']
+        print(f'{codec}: {len(data) / 1e6:.1f} MB, decode {best_of(lambda: decode(data)):.0f} ms, '
+              f'encode {best_of(lambda: encode(decoded)):.0f} ms, '
+              f'read one inventory {best_of(lambda: Inventory.from_dict(first), repeat=1000):.3f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
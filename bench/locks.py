@@ -0,0 +1,55 @@
+"""Stress-tests the per-user locks: many commands add items to the same few users at once from worker threads, and
+every item they add must end up in the users' inventories. The same is then done without the locks, to show how many
+items are lost when the changes interleave.
+
+Accounts are written to a temporary file, not to the bot's own. Run from the bot's root directory:
+    python -m subs.miniscape.bench.locks [users] [commands per user]"""
+import asyncio
+import functools
+import os
+import sys
+import tempfile
+
+from subs.miniscape import locks
+from subs.miniscape import users
+from subs.miniscape import userstore
+
+FIRST_USERID = 900000
+
+
+async def add_items(userids, commands, itemid, hold_locks):
+    """Adds an item to each user once per command, with every command running at the same time in worker threads,
+    and returns the number of the item each user ends up with."""
+    loop = asyncio.get_running_loop()
+
+    async def command(userid):
+        if hold_locks:
+            async with locks.hold(userid):
+                await loop.run_in_executor(None, functools.partial(users.update_inventory, userid, [itemid]))
+        else:
+            await loop.run_in_executor(None, functools.partial(users.update_inventory, userid, [itemid]))
+
+    await asyncio.gather(*(command(userid) for _ in range(commands) for userid in userids))
+    return {userid: users.read_user(userid)[itemid] for userid in userids}
+
+
+async def main(number=20, commands=50):
+    userids = list(range(FIRST_USERID, FIRST_USERID + number))
+    with tempfile.TemporaryDirectory() as directory:
+        userstore._STORE['store'] = userstore.FileStore(os.path.join(directory, 'users.json'))
+        try:
+            locked = await add_items(userids, commands, '1', True)
+            unlocked = await add_items(userids, commands, '2', False)
+        finally:
+            userstore.flush()
+            userstore._STORE['store'] = None
+
+    wrong = {userid: total for userid, total in locked.items() if total != commands}
+    print(f'with locks: {number * commands - sum(locked.values())} of {number * commands} items lost')
+    print(f'without locks: {number * commands - sum(unlocked.values())} of {number * commands} items lost')
+    if wrong:
+        sys.exit(f'users with the wrong number of items: {wrong}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
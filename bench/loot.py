@@ -0,0 +1,69 @@
+"""Checks that rolling loot in a batch with numpy gives the same distribution as rolling it one draw at a time, then
+times both ways for different numbers of kills.
+
+For every item of the monster with the largest loot table, the mean and variance of the amount dropped over many
+rolls are compared between the two ways, as a z-score of the difference in means. Run from the bot's root directory:
+    python -m subs.miniscape.bench.loot [kills per roll] [rolls]"""
+import statistics
+import sys
+import time
+
+from subs.miniscape import monsters as mon
+
+MAX_Z = 4                   # Largest z-score of a difference in means that is put down to chance.
+TIMED_KILLS = (10, 100, 500, 10000)
+
+
+def roll(monsterid, kills, batched):
+    """Rolls the loot of a number of kills in batch or one draw at a time."""
+    batch_draws = mon.LOOT_BATCH_DRAWS
+    mon.LOOT_BATCH_DRAWS = 0 if batched else float('inf')
+    try:
+        return mon.get_loot(monsterid, kills)
+    finally:
+        mon.LOOT_BATCH_DRAWS = batch_draws
+
+
+def compare(monsterid, kills, rolls):
+    """Prints the mean and variance of each item's drops both ways, and returns the largest z-score of the
+    difference in means."""
+    loop = [roll(monsterid, kills, False) for _ in range(rolls)]
+    batched = [roll(monsterid, kills, True) for _ in range(rolls)]
+    worst = 0
+    for itemid in mon.get_loot_table(monsterid):
+        loop_drops = [loot[itemid] for loot in loop]
+        batched_drops = [loot[itemid] for loot in batched]
+        loop_mean, batched_mean = statistics.mean(loop_drops), statistics.mean(batched_drops)
+        loop_var, batched_var = statistics.variance(loop_drops), statistics.variance(batched_drops)
+        z = (loop_mean - batched_mean) / (((loop_var + batched_var) / rolls) ** 0.5 or 1)
+        worst = max(worst, abs(z))
+        print(f'item {itemid:>4}: loop mean {loop_mean:9.2f} var {loop_var:10.2f}, '
+              f'batched mean {batched_mean:9.2f} var {batched_var:10.2f}, z {z:+.2f}')
+    return worst
+
+
+def time_roll(monsterid, kills, batched):
+    """Gets the average time in milliseconds of rolling the loot of a number of kills."""
+    repeat = max(3, 2000 // kills)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        roll(monsterid, kills, batched)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(kills=100, rolls=3000):
+    if mon.numpy is None:
+        sys.exit('numpy is not installed, so loot is never rolled in batch.')
+    monsterid = max(mon.MONSTERS, key=lambda monsterid: len(mon.get_loot_table(monsterid)))
+    print(f'{mon.get_attr(monsterid)} ({len(mon.get_loot_table(monsterid))} items), {rolls} rolls of {kills} kills')
+    worst = compare(monsterid, kills, rolls)
+    print(f'largest |z|: {worst:.2f}')
+    for timed_kills in TIMED_KILLS:
+        print(f'{timed_kills} kills: loop {time_roll(monsterid, timed_kills, False):.2f} ms, '
+              f'batched {time_roll(monsterid, timed_kills, True):.2f} ms')
+    if worst > MAX_Z:
+        sys.exit(f'the distributions differ by more than chance (|z| > {MAX_Z}).')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
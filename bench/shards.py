@@ -0,0 +1,63 @@
+"""Times the single-file store against the sharded store: opening the store and reading one account, and changing
+one account and writing it out. Accounts are written to a temporary directory, not to the bot's own.
+
+Run from the bot's root directory:
+    python -m subs.miniscape.bench.shards [accounts] [items per account]"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from subs.miniscape import userstore
+
+
+def make_accounts(number, items):
+    """Makes accounts with the given number of random items each, with inventories as they are in users.json."""
+    random.seed(0)
+    return {str(100000 + userid): {'items': {str(itemid): random.randint(1, 1000)
+                                             for itemid in random.sample(range(1, 400), items)},
+                                   'combat': random.randint(0, 10 ** 7), 'slayer': random.randint(0, 10 ** 7),
+                                   'quests': hex(random.getrandbits(20)), 'equipment': {'1': '63', '2': '66'}}
+            for userid in range(number)}
+
+
+def best_of(func, repeat=5):
+    """Gets the shortest time a function takes over a number of runs, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def time_store(name, open_store, accounts):
+    """Fills a store with accounts, then prints how long it takes to read one account from a newly opened store and
+    to change one account and write it out."""
+    filling = open_store()
+    for userid, account in accounts.items():
+        filling.put(userid, account)
+    filling.flush()
+    userid, account = next(iter(accounts.items()))
+    store = open_store()
+    store.get(userid)
+
+    def change():
+        store.put(userid, account)
+        store.flush()
+
+    print(f'{name}: open and read one account {best_of(lambda: open_store().get(userid)):.1f} ms, '
+          f'change one account {best_of(change):.1f} ms')
+
+
+def main(number=5000, items=120):
+    accounts = make_accounts(number, items)
+    with tempfile.TemporaryDirectory() as directory:
+        time_store('file', lambda: userstore.FileStore(os.path.join(directory, 'users.json')), accounts)
+        time_store(f'sharded ({userstore.SHARDS} shards)',
+                   lambda: userstore.ShardedStore(os.path.join(directory, 'users', '')), accounts)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,64 @@
+"""Measures how many calls a second the state server answers with different numbers of clients, each client being
+its own process that adds an item to its user and reads the user back in a loop. The server keeps its accounts in a
+temporary directory, not in the bot's own files.
+
+Run from the bot's root directory:
+    python -m subs.miniscape.bench.stateserver [calls per client] [clients...]"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from subs.miniscape import stateclient
+from subs.miniscape import stateserver
+from subs.miniscape import users
+from subs.miniscape import userstore
+
+FIRST_USERID = 800000
+CLIENTS = (1, 4, 8)
+
+
+def run_server(directory, path):
+    """Runs the state server on a socket, with its accounts kept in a directory."""
+    userstore._STORE['store'] = userstore.FileStore(os.path.join(directory, 'users.json'))
+    asyncio.run(stateserver.serve(path))
+
+
+def run_client(path, number, calls, results):
+    """Makes a number of calls to the state server and records how long they took."""
+    stateclient.install(path)
+    userid = FIRST_USERID + number
+    start = time.perf_counter()
+    for _ in range(calls // 2):
+        users.update_inventory(userid, ['1'])
+        users.read_user(userid)
+    results.put(time.perf_counter() - start)
+
+
+def main(calls=1000, *clients):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.sock')
+        server = multiprocessing.Process(target=run_server, args=(directory, path), daemon=True)
+        server.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        try:
+            for number in clients or CLIENTS:
+                results = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=run_client, args=(path, i, calls, results))
+                             for i in range(number)]
+                for process in processes:
+                    process.start()
+                seconds = max(results.get() for _ in processes)
+                for process in processes:
+                    process.join()
+                print(f'{number} clients: {number * (calls // 2) * 2 / seconds:.0f} calls/s')
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,71 @@
+"""Measures how long a cheap command waits while expensive replies are being built, with the replies built on the
+event loop and in the game threads. The cheap command checks whether a user is on an adventure; the expensive ones
+list the monsters, the shop and a monster's loot. Accounts and adventures are read from a temporary directory, not
+from the bot's own files.
+
+Run from the bot's root directory:
+    python -m subs.miniscape.bench.threads [cheap commands] [expensive commands per task]"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from subs.miniscape import adventures as adv
+from subs.miniscape import items
+from subs.miniscape import monsters as mon
+from subs.miniscape import userstore
+from subs.miniscape import workers
+
+EXPENSIVE_TASKS = 4
+USERID = 900000
+
+
+async def cheap(commands, times):
+    """Runs the cheap command a number of times, recording how long each took."""
+    for _ in range(commands):
+        start = time.perf_counter()
+        await workers.run_in_thread(adv.is_on_adventure, USERID)
+        times.append(time.perf_counter() - start)
+        await asyncio.sleep(0.002)
+
+
+async def expensive(commands, in_threads):
+    """Builds a number of expensive replies, on the event loop or in the game threads."""
+    names = [mon.get_attr(monsterid) for monsterid in mon.MONSTERS]
+    for _ in range(commands):
+        for func, args in ((mon.print_list, ()), (items.print_shop, (USERID,)),
+                           (mon.print_monster, (random.choice(names),))):
+            if in_threads:
+                await workers.run_in_thread(func, *args)
+            else:
+                func(*args)
+            await asyncio.sleep(0)
+
+
+async def measure(cheap_commands, expensive_commands, in_threads):
+    """Prints how long the cheap command took while the expensive replies were being built."""
+    times = []
+    await asyncio.gather(cheap(cheap_commands, times),
+                         *(expensive(expensive_commands, in_threads) for _ in range(EXPENSIVE_TASKS)))
+    workers.shutdown()
+    times.sort()
+    print(f'{"in threads" if in_threads else "on the event loop"}: p50 {times[len(times) // 2] * 1000:.1f} ms, '
+          f'p99 {times[len(times) * 99 // 100] * 1000:.1f} ms, worst {times[-1] * 1000:.1f} ms')
+
+
+def main(cheap_commands=300, expensive_commands=30):
+    with tempfile.TemporaryDirectory() as directory:
+        userstore._STORE['store'] = userstore.FileStore(os.path.join(directory, 'users.json'))
+        adv.ADVENTURES_FILE = os.path.join(directory, 'adventures.jsonl')
+        adv.LEGACY_ADVENTURES_FILE = os.path.join(directory, 'current_adventures.txt')
+        try:
+            for in_threads in (False, True):
+                asyncio.run(measure(cheap_commands, expensive_commands, in_threads))
+        finally:
+            userstore._STORE['store'] = None
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
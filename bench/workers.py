@@ -0,0 +1,66 @@
+"""Measures how long the event loop is held up while loot is rolled, with the rolls run on the event loop itself and
+in worker processes. A probe task sleeps for PROBE_INTERVAL seconds over and over, and how much later than asked it
+wakes up is the event loop's lag. Pass 0 for batched to roll loot one draw at a time, as when numpy is not
+installed; worker processes are forked from this one, so they roll it the same way.
+
+Run from the bot's root directory:
+    python -m subs.miniscape.bench.workers [rolls] [kills per roll] [batched]"""
+import asyncio
+import sys
+import time
+
+from subs.miniscape import monsters as mon
+from subs.miniscape import slayer
+from subs.miniscape import workers
+
+PROBE_INTERVAL = 0.005
+PROCESSES = (0, 2, 4)
+
+
+async def probe(stop, lags):
+    """Records how late the event loop wakes the probe up, until told to stop."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def roll_on_loop(monsterid, kills):
+    """Rolls loot on the event loop, as the bot did before rolls were sent to worker processes."""
+    result = slayer.roll_kill_result(monsterid, kills)
+    await asyncio.sleep(0)
+    return result
+
+
+async def measure(monsterid, rolls, kills, processes):
+    """Rolls loot a number of times at once and prints how long it took and the event loop's lag meanwhile. With no
+    processes the rolls are run on the event loop."""
+    workers.WORKER_PROCESSES = processes
+    if processes:
+        await workers.run(slayer.roll_kill_result, monsterid, 1)
+    stop, lags = asyncio.Event(), []
+    probing = asyncio.ensure_future(probe(stop, lags))
+    start = time.perf_counter()
+    if processes:
+        await asyncio.gather(*(workers.run(slayer.roll_kill_result, monsterid, kills) for _ in range(rolls)))
+    else:
+        await asyncio.gather(*(roll_on_loop(monsterid, kills) for _ in range(rolls)))
+    total = time.perf_counter() - start
+    stop.set()
+    await probing
+    workers.shutdown()
+    lags.sort()
+    print(f'{processes or "no"} processes: {rolls} rolls of {kills} kills in {total * 1000:.0f} ms, '
+          f'lag p50 {lags[len(lags) // 2] * 1000:.1f} ms, worst {lags[-1] * 1000:.1f} ms')
+
+
+def main(rolls=100, kills=500, batched=1):
+    if not batched:
+        mon.LOOT_BATCH_DRAWS = float('inf')
+    monsterid = max(mon.MONSTERS, key=lambda monsterid: len(mon.get_loot_table(monsterid)))
+    for number in PROCESSES:
+        asyncio.run(measure(monsterid, rolls, kills, number))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,117 @@
+"""This module contains the combat model that the chance of success and the length of slayer tasks, kills and quests
+are worked out from. The stats of every monster and quest are also held as arrays, so that the model can be worked
+out for a player against all of them at once."""
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from subs.miniscape import monsters as mon
+from subs.miniscape import quests
+from subs.miniscape import users
+
+ANTI_DRAGON_SHIELD = '266'  # Item that protects its wearer from dragonfire.
+DRAGONFIRE = 100            # How many times harder a dragon is to fight without an anti-dragon shield.
+
+# The parts of a user's account that the model is worked out from, read once so that trying many monsters or quests
+# does not read the account again for each.
+PlayerStats = namedtuple('PlayerStats', ['combat_level', 'slayer_level', 'damage', 'accuracy', 'armour',
+                                         'anti_dragon'])
+
+# The stats of a set of monsters or quests, each field holding one value per id in ids. base_time is the time in
+# seconds of a quest, or of killing one of a monster. Fields are numpy arrays, or lists if numpy is not installed.
+Opponents = namedtuple('Opponents', ['ids', 'level', 'accuracy', 'damage', 'armour', 'dragon', 'base_time'])
+
+# The model worked out for a player against a set of Opponents: the chance of success against each, and how many
+# times its base time fighting it takes the player.
+Combat = namedtuple('Combat', ['ids', 'chance', 'base_time', 'ratio'])
+
+_OPPONENTS = {'monsters': None, 'quests': None}
+
+
+def calc_attack(player):
+    """Calculates how fast a player deals damage, which the time they take to fight anything is inversely
+    proportional to."""
+    dam_multiplier = 1 + player.accuracy / 200
+    return player.damage * dam_multiplier + player.combat_level
+
+
+def calc_chance(player, level, accuracy, damage, dragon):
+    """Calculates a player's chance of success, in percent, against a monster or quest with the given stats."""
+    monster_base = DRAGONFIRE if dragon and not player.anti_dragon else 1
+    c = 1 + level / 200
+    d = player.slayer_level / 200
+    dam_multiplier = monster_base + accuracy / 200
+    return round(min(100 * max(0, (player.armour / (damage * dam_multiplier + c)) / 2 + d), 100))
+
+
+def calc_length_ratio(player, armour, dragon):
+    """Calculates how many times its base time a player takes to fight a monster or quest with the given stats."""
+    monster_base = DRAGONFIRE if dragon and not player.anti_dragon else 1
+    return armour * monster_base / calc_attack(player)
+
+
+def evaluate(player, opponents):
+    """Works out the model for a player against every one of a set of Opponents at once."""
+    if numpy is None:
+        stats = zip(opponents.level, opponents.accuracy, opponents.damage, opponents.armour, opponents.dragon)
+        chances, ratios = [], []
+        for level, accuracy, damage, armour, dragon in stats:
+            chances.append(calc_chance(player, level, accuracy, damage, dragon))
+            ratios.append(calc_length_ratio(player, armour, dragon))
+        return Combat(opponents.ids, chances, opponents.base_time, ratios)
+
+    monster_base = numpy.where(opponents.dragon & (not player.anti_dragon), DRAGONFIRE, 1)
+    c = 1 + opponents.level / 200
+    d = player.slayer_level / 200
+    dam_multiplier = monster_base + opponents.accuracy / 200
+    chances = numpy.round(numpy.minimum(
+        100 * numpy.maximum(0, (player.armour / (opponents.damage * dam_multiplier + c)) / 2 + d), 100))
+    ratios = opponents.armour * monster_base / calc_attack(player)
+    return Combat(opponents.ids, chances.astype(int), opponents.base_time, ratios)
+
+
+def get_monster_stats():
+    """Gets the stats of every monster as Opponents."""
+    if _OPPONENTS['monsters'] is None:
+        ids = list(mon.MONSTERS)
+        _OPPONENTS['monsters'] = _make_opponents(
+            ids, [mon.get_attr(monsterid, key=mon.LEVEL_KEY) for monsterid in ids],
+            [mon.get_attr(monsterid, key=mon.ACCURACY_KEY) for monsterid in ids],
+            [mon.get_attr(monsterid, key=mon.DAMAGE_KEY) for monsterid in ids],
+            [mon.get_attr(monsterid, key=mon.ARMOUR_KEY) for monsterid in ids],
+            [bool(mon.get_attr(monsterid, key=mon.DRAGON_KEY)) for monsterid in ids],
+            [mon.get_attr(monsterid, key=mon.XP_KEY) / 10 for monsterid in ids])
+    return _OPPONENTS['monsters']
+
+
+def get_player_stats(userid):
+    """Reads the stats of a user that the model is worked out from."""
+    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
+    damage, accuracy, armour = users.get_equipment_stats(equipment)
+    combat_level = users.xp_to_level(users.read_user(userid, key=users.COMBAT_XP_KEY))
+    slayer_level = users.xp_to_level(users.read_user(userid, key=users.SLAYER_XP_KEY))
+    return PlayerStats(combat_level, slayer_level, damage, accuracy, armour, ANTI_DRAGON_SHIELD in equipment)
+
+
+def get_quest_stats():
+    """Gets the stats of every quest as Opponents."""
+    if _OPPONENTS['quests'] is None:
+        ids = list(quests.QUESTS)
+        _OPPONENTS['quests'] = _make_opponents(
+            ids, [quests.get_attr(questid, key=quests.LEVEL_KEY) for questid in ids],
+            [quests.get_attr(questid, key=quests.ACCURACY_KEY) for questid in ids],
+            [quests.get_attr(questid, key=quests.DAMAGE_KEY) for questid in ids],
+            [quests.get_attr(questid, key=quests.ARMOUR_KEY) for questid in ids],
+            [bool(quests.get_attr(questid, key=quests.DRAGON_KEY)) for questid in ids],
+            [60 * quests.get_attr(questid, key=quests.TIME_KEY) for questid in ids])
+    return _OPPONENTS['quests']
+
+
+def _make_opponents(ids, *stats):
+    """Makes Opponents from lists of stats, as numpy arrays if numpy is installed."""
+    if numpy is None:
+        return Opponents(ids, *stats)
+    return Opponents(ids, *(numpy.array(stat) for stat in stats))
@@ -40,18 +40,20 @@ def craft(userid, recipe, n=1):
                f'higher than your artisan level ({artisan_level}).'
 
     inputs = get_attr(recipeid)
-    loot = []
+    inventory = users.read_user(userid, key=users.ITEMS_KEY)
+    loot = Counter()
     for itemid in list(inputs.keys()):
-        if users.item_in_inventory(userid, itemid, number=n * inputs[itemid]):
-            loot.extend((n * inputs[itemid]) * [itemid])
+        if inventory.get(str(itemid), 0) >= n * inputs[itemid]:
+            loot[itemid] = n * inputs[itemid]
         else:
             return f'Error: you do not have enough items to make {n} {items.add_plural(recipeid)} ' \
                    f'({n * inputs[itemid]} {items.add_plural(itemid)}).'
 
-    users.update_inventory(userid, loot, remove=True)
-    users.update_inventory(userid, n * [recipeid])
     xp = n * items.get_attr(recipeid, key=items.XP_KEY)
-    users.update_user(userid, xp, key=users.ARTISAN_XP_KEY)
+    with users.Changeset(userid) as changes:
+        changes.remove_items(loot)
+        changes.add_items(n * [recipeid])
+        changes.add_xp(xp, users.ARTISAN_XP_KEY)
 
     xp_formatted = '{:,}'.format(xp)
     return f'Successfully crafted {n} {items.add_plural(recipeid)}! You have also gained {xp_formatted} artisan xp!'
@@ -101,7 +103,8 @@ def calc_number(userid, itemid, time):
     return number
 
 
-def get_gather(person, *args):
+def get_gather(person, *args, result=None):
+    """Gives a user the items and xp from a gathering session, which has nothing random to roll."""
     try:
         itemid, item_name, number, length = args[0]
     except ValueError as e:
@@ -109,8 +112,9 @@ def get_gather(person, *args):
         raise ValueError
     loot = int(number) * [itemid]
     xp = int(number) * items.get_attr(itemid, key=items.XP_KEY)
-    users.update_inventory(person.id, loot)
-    users.update_user(person.id, xp, key=users.GATHER_XP_KEY)
+    with users.Changeset(person.id) as changes:
+        changes.add_items(loot)
+        changes.add_xp(xp, users.GATHER_XP_KEY)
 
     xp_formatted = '{:,}'.format(xp)
     out = f'{GATHER_HEADER}' \
@@ -166,7 +170,9 @@ def print_status(time_left, *args):
 def start_gather(userid, item, length=-1, number=-1):
     """Starts a gathering session."""
     out = ''
-    if not adv.is_on_adventure(userid):
+    if item == 'GET_UPDATE':
+        return adv.print_adventure(userid)
+    if not adv.is_queue_full(userid):
         try:
             itemid = items.find_by_name(item)
             length = int(length)
@@ -199,9 +205,12 @@ def start_gather(userid, item, length=-1, number=-1):
             length = math.floor(calc_length(userid, itemid, number)[1] / 60)
         else:
             return 'Error: argument missing (number or kill length).'
-        gather = adv.format_line(3, userid, adv.get_finish_time(length * 60), itemid, item_name, number, length)
-        adv.write(gather)
-        out += f'You are now gathering {number} {items.add_plural(itemid)} for {length} minutes.'
+        position = adv.start(adv.GATHER, userid, length * 60, itemid, item_name, number, length)
+        if position == 0:
+            out += f'You are now gathering {number} {items.add_plural(itemid)} for {length} minutes.'
+        else:
+            out += f'You will gather {number} {items.add_plural(itemid)} for {length} minutes. ' \
+                   f'{adv.print_queued(position)}'
     else:
         out = adv.print_adventure(userid)
         out += adv.print_on_adventure_error('gathering')
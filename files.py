@@ -6,8 +6,24 @@ QUESTS_JSON = f'{RESOURCES_DIRECTORY}quests.json'
 XP_FILE = f'{RESOURCES_DIRECTORY}xp.txt'
 ARMOUR_SLOTS_FILE = f'{RESOURCES_DIRECTORY}armour.txt'
 USERS_JSON = f'{RESOURCES_DIRECTORY}users.json'
+USERS_MSGPACK = f'{RESOURCES_DIRECTORY}users.msgpack'
+USERS_DB = f'{RESOURCES_DIRECTORY}users.db'
+USERS_JOURNAL = f'{RESOURCES_DIRECTORY}users.journal'
+USERS_DIRECTORY = f'{RESOURCES_DIRECTORY}users/'
+USERS_BACKEND = 'json'      # Where accounts are stored: 'json' (USERS_JSON), 'msgpack' (USERS_MSGPACK), 'sqlite'
+                            # (USERS_DB), 'journal' (USERS_JOURNAL, periodically compacted into USERS_JSON) or
+                            # 'sharded' (USERS_DIRECTORY).
+STATE_SOCKET = f'{RESOURCES_DIRECTORY}state.sock'
+USE_STATE_SERVER = False    # Whether to send account and adventure changes to the state server on STATE_SOCKET
+                            # instead of reading and writing the files directly.
+EAGER_RESULTS = False       # Whether the random parts of an adventure's result (loot and success) are rolled when it
+                            # starts and stored with it, rather than when it finishes.
+WORKER_PROCESSES = 2        # Number of processes loot is rolled in when adventures finish. 0 rolls it in this process.
+GAME_THREADS = 4            # Number of threads commands read and write game files and build their replies in.
+STATS_FILE = f'{RESOURCES_DIRECTORY}stats.json'
 RECIPE_JSON = f'{RESOURCES_DIRECTORY}recipes.json'
 SKILLS_FILE = f'{RESOURCES_DIRECTORY}skills.txt'
-ADVENTURES_FILE = f'{RESOURCES_DIRECTORY}current_adventures.txt'
+ADVENTURES_FILE = f'{RESOURCES_DIRECTORY}adventures.jsonl'
+LEGACY_ADVENTURES_FILE = f'{RESOURCES_DIRECTORY}current_adventures.txt'   # Converted to ADVENTURES_FILE on first load.
 SHOP_FILE = f'{RESOURCES_DIRECTORY}shop.txt'
 CREATOR_ID = 293219528450637824
\ No newline at end of file
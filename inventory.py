@@ -0,0 +1,160 @@
+"""This module contains the Inventory type that user inventories are held in."""
+from array import array
+from collections.abc import MutableMapping
+
+# Converting between string and integer item ids is most of the cost of loading and saving inventories, so the
+# strings for the first few thousand ids are made once and looked up instead.
+ID_STRINGS = [str(itemid) for itemid in range(8192)]
+ID_INTS = {itemid: int(itemid) for itemid in ID_STRINGS}
+
+
+class Inventory(MutableMapping):
+    """A user's inventory, keyed by integer item id. It is stored as two parallel arrays (item ids and how many of
+    each the user has) rather than a dictionary, and behaves like a Counter: missing items have a count of 0, and
+    update() adds to the counts rather than replacing them. Item ids may be given as ints or as the strings used in
+    users.json.
+
+    The arrays are kept in the order items were added, like a dictionary. Inventories hold at most a few hundred
+    items, so finding one with array.index is as quick as a binary search, and loading one needs no sorting."""
+
+    def __init__(self, itemids=(), numbers=()):
+        self._itemids = array('q', itemids)
+        self._numbers = array('q', numbers)
+
+    def __contains__(self, itemid):
+        return self._find(itemid) is not None
+
+    def __copy__(self):
+        return Inventory(self._itemids, self._numbers)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __delitem__(self, itemid):
+        index = self._find(itemid)
+        if index is None:
+            raise KeyError(itemid)
+        del self._itemids[index]
+        del self._numbers[index]
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == {int(itemid): number for itemid, number in other.items() if number != 0}
+
+    def __getitem__(self, itemid):
+        index = self._find(itemid)
+        return self._numbers[index] if index is not None else 0
+
+    def __iter__(self):
+        return iter(self._itemids)
+
+    def __len__(self):
+        return len(self._itemids)
+
+    def __repr__(self):
+        return f'Inventory({dict(self.items())})'
+
+    def __setitem__(self, itemid, number):
+        index = self._find(itemid)
+        if index is not None:
+            self._numbers[index] = number
+        else:
+            self._itemids.append(int(itemid))
+            self._numbers.append(number)
+
+    def add(self, itemid, number=1):
+        """Adds (or with a negative number, removes) a number of an item, and returns how many are left. Items that
+        reach 0 are dropped from the inventory."""
+        total = self[itemid] + number
+        if total == 0:
+            if itemid in self:
+                del self[itemid]
+        else:
+            self[itemid] = total
+        return total
+
+    def contains(self, loot):
+        """Determines whether the inventory has at least as many of each item as a list or mapping of items."""
+        if not hasattr(loot, 'items'):
+            loot = Inventory.from_list(loot)
+        return all(self[itemid] >= number for itemid, number in loot.items())
+
+    def copy(self):
+        return self.__copy__()
+
+    def get(self, itemid, default=None):
+        index = self._find(itemid)
+        return self._numbers[index] if index is not None else default
+
+    def items(self):
+        return list(zip(self._itemids, self._numbers))
+
+    def keys(self):
+        return self._itemids.tolist()
+
+    def subtract(self, loot):
+        """Removes a list or mapping of items. Counts may go negative, as with Counter.subtract."""
+        for itemid, number in _pairs(loot):
+            self.add(itemid, -number)
+
+    def toDict(self):
+        """Converts the inventory to the {'itemid': number} dictionary stored in users.json. ujson calls this method
+        by name when it is asked to serialise an Inventory."""
+        if self._itemids and 0 <= min(self._itemids) and max(self._itemids) < len(ID_STRINGS):
+            itemids = map(ID_STRINGS.__getitem__, self._itemids)
+        else:
+            itemids = map(str, self._itemids)
+        return dict(zip(itemids, self._numbers))
+
+    def update(self, loot=()):
+        """Adds a list or mapping of items, as with Counter.update."""
+        for itemid, number in _pairs(loot):
+            self.add(itemid, number)
+
+    def value(self, get_value, under=None):
+        """Gets the total value of the inventory given a function that returns an item's value from its id. Items worth
+        at least under are left out."""
+        total_value = 0
+        for itemid, number in self.items():
+            value = get_value(itemid)
+            if under is None or value < under:
+                total_value += number * value
+        return total_value
+
+    def values(self):
+        return self._numbers.tolist()
+
+    def _find(self, itemid):
+        """Gets the position of an item in the arrays, or None if it is not in the inventory."""
+        try:
+            return self._itemids.index(int(itemid))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def from_dict(cls, inventory):
+        """Creates an inventory from a mapping of item ids to numbers, such as the dictionaries in users.json."""
+        if isinstance(inventory, Inventory):
+            return inventory.copy()
+        if 0 in inventory.values():
+            inventory = {itemid: number for itemid, number in inventory.items() if number != 0}
+        try:
+            itemids = map(ID_INTS.__getitem__, inventory.keys())
+            return cls(itemids, inventory.values())
+        except KeyError:
+            return cls(map(int, inventory.keys()), inventory.values())
+
+    @classmethod
+    def from_list(cls, loot):
+        """Creates an inventory from a list of item ids, each of which counts as one of that item."""
+        inventory = cls()
+        inventory.update(loot)
+        return inventory
+
+
+def _pairs(loot):
+    """Gets (itemid, number) pairs from either a mapping of items or a list of item ids."""
+    if hasattr(loot, 'items'):
+        return list(loot.items())
+    return [(itemid, 1) for itemid in loot]
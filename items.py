@@ -2,7 +2,6 @@
 import ujson
 
 from subs.miniscape import users
-from subs.gastercoin import account as ac
 from subs.miniscape import monsters as mon
 from subs.miniscape.files import ITEM_JSON, SHOP_FILE
 
@@ -70,8 +69,9 @@ def buy(userid, item, number):
         items = open_shop()
         if int(items[itemid]) in users.get_completed_quests(userid) or int(items[itemid]) == 0:
             value = get_attr(itemid, key=VALUE_KEY)
-            users.update_inventory(userid, [itemid]*number)
-            ac.update_account(userid, -(4 * number * value))
+            with users.Changeset(userid) as changes:
+                changes.add_items([itemid]*number)
+                changes.add_coins(-(4 * number * value))
             value_formatted = '{:,}'.format(4 * value * number)
             return f'{number} {item_name} bought for G${value_formatted}!'
         else:
@@ -158,8 +158,9 @@ def sell(userid, item, number):
     item_name = get_attr(itemid)
     if users.item_in_inventory(userid, itemid, number=number):
         value = get_attr(itemid, key=VALUE_KEY)
-        users.update_inventory(userid, [itemid]*number, remove=True)
-        ac.update_account(userid, number * value)
+        with users.Changeset(userid) as changes:
+            changes.remove_items([itemid]*number)
+            changes.add_coins(number * value)
         value_formatted = '{:,}'.format(value * number)
         return f'{number} {item_name} sold for G${value_formatted}!'
     else:
@@ -0,0 +1,29 @@
+"""This module contains the per-user locks that keep two commands from changing the same user's state at once."""
+import asyncio
+import contextlib
+
+_LOCKS = {}
+
+
+def get_lock(userid):
+    """Gets the lock for a user, creating it the first time it is asked for."""
+    userid = str(userid)
+    if userid not in _LOCKS:
+        _LOCKS[userid] = asyncio.Lock()
+    return _LOCKS[userid]
+
+
+@contextlib.asynccontextmanager
+async def hold(*userids):
+    """Holds the locks for one or more users until the block is left. The locks are always taken in order of userid,
+    so two commands that both need the same pair of users cannot each end up waiting on the other."""
+    held = []
+    try:
+        for userid in sorted({str(userid) for userid in userids}):
+            lock = get_lock(userid)
+            await lock.acquire()
+            held.append(lock)
+        yield
+    finally:
+        for lock in reversed(held):
+            lock.release()
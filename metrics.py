@@ -0,0 +1,68 @@
+"""This module contains rolling histograms of how long adventure completion takes, so that delivery of results can be
+measured against a target."""
+import collections
+import os
+import threading
+import time
+import ujson
+
+from subs.miniscape.files import STATS_FILE
+
+WINDOW = 1000       # Number of most recent samples each histogram keeps.
+PERCENTILES = (50, 90, 99)
+
+_HISTOGRAMS = {}
+_LOCK = threading.Lock()
+
+
+class Histogram:
+    """Keeps the most recent samples of a measurement and reports percentiles over them."""
+
+    def __init__(self, size=WINDOW):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        """Gets the number of samples ever added, and the percentiles and maximum of the ones still kept."""
+        samples = sorted(self.samples)
+        out = {'count': self.count}
+        if samples:
+            for percentile in PERCENTILES:
+                out[f'p{percentile}'] = samples[min(len(samples) - 1, len(samples) * percentile // 100)]
+            out['max'] = samples[-1]
+        return out
+
+
+def print_summary():
+    """Writes a string showing the percentiles of every measurement."""
+    out = '__**STATS**__\n'
+    for name, summary in sorted(summarise().items()):
+        values = ', '.join(f'{key} {value:.3f}' for key, value in summary.items() if key != 'count')
+        out += f'**{name}** ({summary["count"]}): {values}\n'
+    return out
+
+
+def record(name, value):
+    """Adds a sample to a measurement. Times are recorded in seconds."""
+    with _LOCK:
+        if name not in _HISTOGRAMS:
+            _HISTOGRAMS[name] = Histogram()
+        _HISTOGRAMS[name].add(value)
+
+
+def summarise():
+    """Gets the summary of every measurement, keyed by name."""
+    with _LOCK:
+        return {name: histogram.summary() for name, histogram in _HISTOGRAMS.items()}
+
+
+def write(path=STATS_FILE):
+    """Writes the summary of every measurement to a JSON file."""
+    data = {'time': time.time(), 'stats': summarise()}
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(ujson.dumps(data, indent=4))
+    os.replace(f'{path}.tmp', path)
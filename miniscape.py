@@ -1,17 +1,25 @@
 """Implements commands related to running a freemium-style text-based RPG."""
 import asyncio
+import functools
+import time
 
 from discord.ext import commands
 
 import config
-from subs.gastercoin import account as ac
 from subs.miniscape import adventures as adv
+from subs.miniscape import files
 from subs.miniscape import items
+from subs.miniscape import locks
+from subs.miniscape import metrics
 from subs.miniscape import monsters as mon
+from subs.miniscape import outbox
 from subs.miniscape import quests
 from subs.miniscape import craft
 from subs.miniscape import slayer
+from subs.miniscape import stateclient
 from subs.miniscape import users
+from subs.miniscape import userstore
+from subs.miniscape import workers
 
 RESOURCES_DIRECTORY = f'./subs/miniscape/resources/'
 
@@ -22,33 +30,52 @@ BANK_CHANNEL = 471440651620319233
 SHOP_CHANNEL = 471445748995850240
 ANNOUNCEMENTS_CHANNEL = 471814213300518933
 
+ADVENTURE_ERROR = '<@{}>, something went wrong finishing your adventure, so it has not been counted.'
+
+SEND_RATE = 1   # The most adventure result messages sent to Discord a second. Results waiting to be sent to the
+                # same channel are joined together, so a burst of them needs only a few messages.
+STATS_INTERVAL = 300   # Seconds between writes of the adventure completion stats to STATS_FILE.
+MAX_WAIT = 60   # The longest time in seconds to wait between checks for finished adventures, in case one was added by
+                # another process (see stateserver.py) and so did not wake this one.
+
 
 class Miniscape():
     """Defines Miniscape commands."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.wake = asyncio.Event()
+        self.outbox = outbox.Outbox(lambda channel, content: channel.send(content), rate=SEND_RATE)
+        self.bot.loop.create_task(self.outbox.run())
+        adv.add_listener(lambda: self.bot.loop.call_soon_threadsafe(self.wake.set))
         self.bot.loop.create_task(self.check_adventures())
 
+    @staticmethod
+    async def run(func, *args, **kwargs):
+        """Runs a function that reads or writes game files, or builds a long reply, in a game thread, so the event
+        loop is free to handle other commands while it waits on disk."""
+        return await workers.run_in_thread(func, *args, **kwargs)
+
     @commands.group(invoke_without_command=True)
     async def me(self, ctx):
         """Shows information related to the user."""
         if ctx.channel.id == BANK_CHANNEL:
-            await ctx.send(users.print_account(ctx.author.id))
+            await ctx.send(await self.run(users.print_account, ctx.author.id))
 
     @me.group(name='equip')
     async def _equip(self, ctx, *args):
         """Equips an item from a user's inventory."""
         if ctx.channel.id == BANK_CHANNEL:
             item = ' '.join(args)
-            out = users.equip_item(ctx.author.id, item.lower())
+            async with locks.hold(ctx.author.id):
+                out = await self.run(users.equip_item, ctx.author.id, item.lower())
             await ctx.send(out)
 
     @commands.group(aliases=['invent', 'inventory', 'item'], invoke_without_command=True)
     async def items(self, ctx, search=''):
         """Show's the player's inventory."""
         if ctx.channel.id == BANK_CHANNEL:
-            inventory = users.print_inventory(ctx.author.id, search.lower())
+            inventory = await self.run(users.print_inventory, ctx.author.id, search.lower())
             for message in inventory:
                 await ctx.send(message)
 
@@ -56,45 +83,50 @@ class Miniscape():
     async def _stats(self, ctx, *args):
         item = ' '.join(args)
         if ctx.channel.id == BANK_CHANNEL:
-            out = items.print_stats(item)
+            out = await self.run(items.print_stats, item)
             await ctx.send(out)
 
     @commands.group(invoke_without_command=True)
     async def slayer(self, ctx):
         """Gives the user a slayer task."""
         if ctx.channel.id == COMBAT_CHANNEL:
-            out = slayer.get_task(ctx.author.id)
+            async with locks.hold(ctx.author.id):
+                out = await self.run(slayer.get_task, ctx.author.id)
             await ctx.send(out)
 
     @commands.group(invoke_without_command=True, aliases=['grind', 'fring'])
     async def kill(self, ctx, *args):
         """Lets the user kill monsters for a certain number or a certain amount of time."""
         if ctx.channel.id == COMBAT_CHANNEL:
-            if len(args) > 0:
-                if args[0].isdigit():
-                    number = args[0]
-                    monster = ' '.join(args[1:])
-                    out = slayer.get_kill(ctx.author.id, monster, number=number)
-                elif args[-1].isdigit():
-                    length = args[-1]
-                    monster = ' '.join(args[:-1])
-                    out = slayer.get_kill(ctx.author.id, monster, length=length)
-                else:
-                    out = 'Error: there must be a number or length of kill in args.'
+            async with locks.hold(ctx.author.id):
+                if len(args) > 0:
+                    if args[0].isdigit():
+                        number = args[0]
+                        monster = ' '.join(args[1:])
+                        out = await self.run(slayer.get_kill, ctx.author.id, monster, number=number)
+                    elif args[-1].isdigit():
+                        length = args[-1]
+                        monster = ' '.join(args[:-1])
+                        out = await self.run(slayer.get_kill, ctx.author.id, monster, length=length)
+                    else:
+                        out = 'Error: there must be a number or length of kill in args.'
 
-            else:
-                if adv.is_on_adventure(ctx.author.id):
-                    out = slayer.get_kill(ctx.author.id, 'GET_UPDATE')
                 else:
-                    out = 'args not valid. Please put in the form `[number] [monster name] [length]`'
+                    if await self.run(adv.is_on_adventure, ctx.author.id):
+                        out = await self.run(slayer.get_kill, ctx.author.id, 'GET_UPDATE')
+                    else:
+                        out = 'args not valid. Please put in the form `[number] [monster name] [length]`'
             await ctx.send(out)
 
     @commands.command(aliases=['starter'])
     async def starter_gear(self, ctx):
         """Gives the user a set of bronze armour."""
         if ctx.channel.id == SHOP_CHANNEL or ctx.channel.id == COMBAT_CHANNEL:
-            if users.read_user(ctx.author.id, key=users.COMBAT_XP_KEY) == 0:
-                users.update_inventory(ctx.author.id, [63, 66, 69, 70])
+            async with locks.hold(ctx.author.id):
+                is_new = await self.run(users.read_user, ctx.author.id, key=users.COMBAT_XP_KEY) == 0
+                if is_new:
+                    await self.run(users.update_inventory, ctx.author.id, [63, 66, 69, 70])
+            if is_new:
                 await ctx.send(f'Bronze set given to {ctx.author.name}! You can see your items by typing `~inventory` '
                                f'and equip them by typing `~me equip [item]`. You can see your current stats by typing '
                                f'`~me`.')
@@ -107,71 +139,86 @@ class Miniscape():
         if ctx.channel.id == BANK_CHANNEL:
             monster = ' '.join(args)
             if monster == '':
-                messages = mon.print_list()
+                messages = await self.run(mon.print_list)
             else:
-                messages = mon.print_monster(monster)
+                messages = await self.run(mon.print_monster, monster)
             for message in messages:
                 await ctx.send(message)
 
     @commands.command()
     async def chance(self, ctx, monsterid, dam=-1, acc=-1, arm=-1, cb=-1, xp=-1, num=100, dfire=False):
-        out = slayer.print_chance(ctx.author.id, monsterid, monster_dam=int(dam), monster_acc=int(acc),
-                                  monster_arm=int(arm), monster_combat=int(cb), xp=int(xp), number=int(num),
-                                  dragonfire=bool(dfire))
+        out = await self.run(slayer.print_chance, ctx.author.id, monsterid, monster_dam=int(dam),
+                             monster_acc=int(acc), monster_arm=int(arm), monster_combat=int(cb), xp=int(xp),
+                             number=int(num), dragonfire=bool(dfire))
         await ctx.send(out)
 
     @commands.command()
     async def cancel(self, ctx):
         """Cancels your current action."""
+        async with locks.hold(ctx.author.id):
+            out = await self.run(self._cancel, ctx.author.id)
+        await ctx.send(out)
+
+    @staticmethod
+    def _cancel(userid):
+        """Cancels a user's current action and returns the message to send them."""
         try:
-            task = adv.get_adventure(ctx.author.id)
+            task = adv.get_adventure(userid)
 
-            adventureid = task[0]
-            if adventureid == '0':
-                if users.item_in_inventory(ctx.author.id, '291', '1'):
-                    users.update_inventory(ctx.author.id, ['291'], remove=True)
-                    adv.remove(ctx.author.id)
+            adventureid = task.adventureid
+            if adventureid == adv.SLAYER_TASK:
+                if users.item_in_inventory(userid, '291', '1'):
+                    users.update_inventory(userid, ['291'], remove=True)
+                    adv.remove(userid)
                     out = 'Slayer task cancelled!'
                 else:
                     out = 'Error: You do not have a reaper token.'
-            elif adventureid == '1':
-                adv.remove(ctx.author.id)
+            elif adventureid == adv.KILL:
+                adv.remove(userid)
                 out = 'Killing session cancelled!'
-            elif adventureid == '2':
-                adv.remove(ctx.author.id)
+            elif adventureid == adv.QUEST:
+                adv.remove(userid)
                 out = 'Quest cancelled!'
-            elif adventureid == '3':
-                adv.remove(ctx.author.id)
+            elif adventureid == adv.GATHER:
+                adv.remove(userid)
                 out = 'Gather cancelled!'
             else:
                 out = f'Error: Invalid Adventure ID {adventureid}'
 
         except NameError:
             out = 'You are not currently doing anything.'
-        await ctx.send(out)
+        return out
 
     @commands.command()
     async def compare(self, ctx, item1, item2):
         """Compares the stats of two items."""
         if ctx.channel.id == BANK_CHANNEL:
-            out = items.compare(item1.lower(), item2.lower())
+            out = await self.run(items.compare, item1.lower(), item2.lower())
             await ctx.send(out)
 
     @commands.command()
     async def status(self, ctx):
         """Tells what you are currently doing."""
         if ctx.channel.id == COMBAT_CHANNEL:
-            if adv.is_on_adventure(ctx.author.id):
-                out = adv.print_adventure(ctx.author.id)
+            if await self.run(adv.is_on_adventure, ctx.author.id):
+                out = await self.run(adv.print_adventure, ctx.author.id)
             else:
                 out = 'You are not currently doing anything.'
             await ctx.send(out)
 
+    @commands.command()
+    async def stats(self, ctx):
+        """Shows how long adventure results are taking to be delivered."""
+        if ctx.author.id == files.CREATOR_ID:
+            await ctx.send(metrics.print_summary())
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
     @commands.group(invoke_without_command=True)
     async def shop(self, ctx):
         """Shows the items available at the shop."""
         if ctx.channel.id == SHOP_CHANNEL:
-            messages = items.print_shop(ctx.author.id)
+            messages = await self.run(items.print_shop, ctx.author.id)
             for message in messages:
                 await ctx.send(message)
 
@@ -180,7 +227,8 @@ class Miniscape():
         """Buys something from the shop."""
         item = ' '.join(args)
         if ctx.channel.id == SHOP_CHANNEL:
-            out = items.buy(ctx.author.id, item, 1)
+            async with locks.hold(ctx.author.id):
+                out = await self.run(items.buy, ctx.author.id, item, 1)
             await ctx.send(out)
 
     @shop.command(name='sell')
@@ -190,18 +238,12 @@ class Miniscape():
             if item != 'all':
                 if number is None:
                     number = 1
-                out = items.sell(ctx.author.id, item, number=None)
+                async with locks.hold(ctx.author.id):
+                    out = await self.run(items.sell, ctx.author.id, item, number=None)
                 await ctx.send(out)
             else:
-                inventory = users.read_user(ctx.author.id)
-                if number is None:
-                    value = users.get_value_of_inventory(inventory)
-                    ac.update_account(ctx.author.id, value)
-                    users.clear_inventory(ctx.author.id)
-                else:
-                    value = users.get_value_of_inventory(inventory, under=number)
-                    ac.update_account(ctx.author.id, value)
-                    users.clear_inventory(ctx.author.id, under=number)
+                async with locks.hold(ctx.author.id):
+                    value = await self.run(users.clear_inventory, ctx.author.id, under=number)
                 value_formatted = '{:,}'.format(value)
                 await ctx.send(f"{ctx.author.name}'s inventory sold for G${value_formatted}")
 
@@ -209,39 +251,41 @@ class Miniscape():
     async def quest(self, ctx, questid=None):
         if ctx.channel.id == COMBAT_CHANNEL:
             if questid is not None:
-                out = quests.print_details(ctx.author.id, questid)
+                out = await self.run(quests.print_details, ctx.author.id, questid)
             else:
-                out = quests.print_list(ctx.author.id)
+                out = await self.run(quests.print_list, ctx.author.id)
             await ctx.send(out)
 
     @quest.command(name='start')
     async def _start(self, ctx, questid):
         """lets a user start a quest."""
         if ctx.channel.id == COMBAT_CHANNEL:
-            out = quests.start_quest(ctx.author.id, questid)
+            async with locks.hold(ctx.author.id):
+                out = await self.run(quests.start_quest, ctx.author.id, questid)
             await ctx.send(out)
 
     @commands.command()
     async def gather(self, ctx, *args):
         """Gathers items."""
         if ctx.channel.id == COMBAT_CHANNEL:
-            if len(args) > 0:
-                if args[0].isdigit():
-                    number = args[0]
-                    item = ' '.join(args[1:])
-                    out = craft.start_gather(ctx.author.id, item, number=number)
-                elif args[-1].isdigit():
-                    length = args[-1]
-                    item = ' '.join(args[:-1])
-                    out = craft.start_gather(ctx.author.id, item, length=length)
-                else:
-                    out = 'Error: there must be a number or length of gathering in args.'
+            async with locks.hold(ctx.author.id):
+                if len(args) > 0:
+                    if args[0].isdigit():
+                        number = args[0]
+                        item = ' '.join(args[1:])
+                        out = await self.run(craft.start_gather, ctx.author.id, item, number=number)
+                    elif args[-1].isdigit():
+                        length = args[-1]
+                        item = ' '.join(args[:-1])
+                        out = await self.run(craft.start_gather, ctx.author.id, item, length=length)
+                    else:
+                        out = 'Error: there must be a number or length of gathering in args.'
 
-            else:
-                if adv.is_on_adventure(ctx.author.id):
-                    out = slayer.get_kill(ctx.author.id, 'GET_UPDATE')
                 else:
-                    out = 'args not valid. Please put in the form `[number] [item name] [length]`'
+                    if await self.run(adv.is_on_adventure, ctx.author.id):
+                        out = await self.run(craft.start_gather, ctx.author.id, 'GET_UPDATE')
+                    else:
+                        out = 'args not valid. Please put in the form `[number] [item name] [length]`'
             await ctx.send(out)
 
 
@@ -249,7 +293,7 @@ class Miniscape():
     async def recipes(self, ctx):
         """Prints a list of recipes a user can create."""
         if ctx.channel.id == BANK_CHANNEL:
-            messages = craft.print_list(ctx.author.id)
+            messages = await self.run(craft.print_list, ctx.author.id)
             for message in messages:
                 await ctx.send(message)
 
@@ -258,7 +302,7 @@ class Miniscape():
         """Lists the details of a particular recipe."""
         if ctx.channel.id == BANK_CHANNEL:
             recipe = ' '.join(args)
-            out = craft.print_recipe(recipe)
+            out = await self.run(craft.print_recipe, recipe)
             await ctx.send(out)
 
     @recipes.command(name='craft')
@@ -270,29 +314,117 @@ class Miniscape():
             except ValueError:
                 number = 1
                 recipe = ' '.join(args)
-            out = craft.craft(ctx.author.id, recipe, n=number)
+            async with locks.hold(ctx.author.id):
+                out = await self.run(craft.craft, ctx.author.id, recipe, n=number)
             await ctx.send(out)
 
     async def check_adventures(self):
-        """Check if any actions are complete and notifies the user if they are done."""
+        """Notifies users as their actions complete, waking as each one is due rather than polling."""
         await self.bot.wait_until_ready()
+        stats_written = time.time()
         while not self.bot.is_closed():
-            finished_tasks = adv.get_finished()
-            for task in finished_tasks:
-                adventureid, userid = int(task[0]), int(task[1])
-                bot_self = self.bot.get_guild(config.guild_id).get_channel(471440571207254017)
-                person = self.bot.get_guild(config.guild_id).get_member(int(userid))
-                adventures = {
-                    0: slayer.get_result,
-                    1: slayer.get_kill_result,
-                    2: quests.get_result,
-                    3: craft.get_gather
-                }
-                out = adventures[adventureid](person, task[3:])
-                await bot_self.send(out)
-            await asyncio.sleep(60)
+            self.wake.clear()
+            start = time.perf_counter()
+            finished_tasks = await self.run(adv.get_finished)
+            picked_up = time.time()
+            metrics.record('get_finished', time.perf_counter() - start)
+            metrics.record('finished_per_tick', len(finished_tasks))
+            if finished_tasks:
+                guild = self.bot.get_guild(config.guild_id)
+                people = {task.userid: guild.get_member(int(task.userid)) for task in finished_tasks}
+                for task in finished_tasks:
+                    metrics.record('pickup_lag', picked_up - task.finish_time)
+                finished_tasks = await self.roll_loot(finished_tasks)
+                async with locks.hold(*people):
+                    results = await self.run(self.resolve_adventures, finished_tasks, people)
+                channel = guild.get_channel(COMBAT_CHANNEL)
+                for task, message in results:
+                    self.outbox.put(channel, message, on_sent=functools.partial(self.record_delivery, task))
+                metrics.record('outbox_depth', len(self.outbox))
+                metrics.record('tick', time.perf_counter() - start)
+            await self.run(userstore.flush)
+            if time.time() - stats_written >= STATS_INTERVAL:
+                await self.run(metrics.write)
+                stats_written = time.time()
+            await self.wait_for_next_adventure()
+
+    @staticmethod
+    def record_delivery(task):
+        """Records how late an adventure's result was delivered, compared to when it was due to finish."""
+        metrics.record('delivery_lag', time.time() - task.finish_time)
+
+    async def roll_loot(self, tasks):
+        """Rolls the loot of finished kill sessions and slayer tasks that was not rolled when they started, in the
+        worker processes, and returns the tasks with their results filled in. Whether a slayer task succeeds depends
+        on the user's gear, which only this process has, so that is rolled first."""
+        def roll_successes():
+            return {task.userid: adv.is_success(slayer.calc_chance(task.userid, task.args.monsterid))
+                    for task in tasks if task.result is None and task.adventureid == adv.SLAYER_TASK}
+
+        successes = await self.run(roll_successes)
+        rolls = {}
+        for task in tasks:
+            if task.result is None and task.adventureid == adv.KILL:
+                rolls[task.userid] = (slayer.roll_kill_result, task.args.monsterid, task.args.number)
+            elif task.result is None and task.adventureid == adv.SLAYER_TASK and successes[task.userid]:
+                rolls[task.userid] = (slayer.roll_success, task.args.monsterid, task.args.num_to_kill)
+        results = {userid: {'success': False, 'loot': {}} for userid, success in successes.items() if not success}
+        rolled = await asyncio.gather(*(workers.run(*roll) for roll in rolls.values()), return_exceptions=True)
+        for (userid, roll), result in zip(rolls.items(), rolled):
+            if isinstance(result, Exception):
+                # Rolled again here with the same function, so a slayer task keeps the success it already rolled.
+                print(f'Could not roll loot for {userid}, so it will be rolled in this process: {result!r}')
+                try:
+                    result = await self.run(*roll)
+                except Exception as e:
+                    print(f'Could not roll loot for {userid}: {e!r}')
+                    if roll[0] is not slayer.roll_success:
+                        continue
+                    result = {'success': True, 'loot': {}}
+            results[userid] = result
+        return [task._replace(result=results[task.userid]) if task.userid in results else task for task in tasks]
+
+    @staticmethod
+    def resolve_adventures(tasks, people):
+        """Works out the results of finished adventures and returns (task, message to send) pairs. Every account
+        change they make is applied together once they have all been worked out. A user whose adventure could not be
+        finished, or whose changes could not be applied, is sent ADVENTURE_ERROR instead, and none of its changes
+        are made."""
+        adventures = {
+            adv.SLAYER_TASK: slayer.get_result,
+            adv.KILL: slayer.get_kill_result,
+            adv.QUEST: quests.get_result,
+            adv.GATHER: craft.get_gather
+        }
+        results = []
+        with users.batch() as skipped:
+            for task in tasks:
+                handler = adventures[task.adventureid]
+                start = time.perf_counter()
+                try:
+                    results.append((task, handler(people[task.userid], task.args, result=task.result)))
+                except Exception as e:
+                    print(f'Could not finish adventure {task}: {e!r}')
+                    users.discard_batched(task.userid)
+                    results.append((task, None))
+                metrics.record(f'handler.{handler.__module__.rsplit(".", 1)[-1]}.{handler.__name__}',
+                               time.perf_counter() - start)
+        failed = {str(userid) for userid in skipped}
+        return [(task, ADVENTURE_ERROR.format(task.userid) if message is None or task.userid in failed else message)
+                for task, message in results]
+
+    async def wait_for_next_adventure(self):
+        """Sleeps until the next adventure finishes, or until an adventure is added that finishes sooner."""
+        delay = await self.run(adv.get_seconds_until_next)
+        delay = MAX_WAIT if delay is None else min(max(delay, 0), MAX_WAIT)
+        try:
+            await asyncio.wait_for(self.wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
 
 def setup(bot):
     """Adds the cog to the bot."""
+    if files.USE_STATE_SERVER:
+        stateclient.install()
     bot.add_cog(Miniscape(bot))
@@ -1,7 +1,14 @@
-from collections import Counter
+from collections import Counter, namedtuple
+import os
+import time
 import ujson
 import random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from subs.miniscape import items
 from subs.miniscape.files import MONSTERS_JSON, MONSTER_DIRECTORY
 
@@ -36,6 +43,27 @@ DEFAULT_MONSTER = {
     DRAGON_KEY: False
 }
 
+LOOT_CHECK_INTERVAL = 60    # Seconds between checks of whether a cached loot table's file has changed.
+LOOT_BATCH_DRAWS = 200      # Fewest loot draws that are rolled all at once with numpy, if it is installed, rather than
+                            # one at a time.
+
+# A monster's loot table as read from its file in MONSTER_DIRECTORY, along with what is worked out from it: the ids of
+# its items as a tuple to draw from, its highest rarity, the ids of its rare items, the ids of the items it always
+# drops, and the ids of the other items with the chance that a single draw drops each of them. It is kept with the
+# modification time of the file and when that was last checked, and read again if the file changes.
+LootTable = namedtuple('LootTable', ['table', 'itemids', 'max_rarity', 'rares', 'always', 'droppable', 'drop_chances',
+                                     'mtime', 'checked'])
+
+# A monster that drops an item, with the amounts and rarity it is dropped in.
+DropSource = namedtuple('DropSource', ['monsterid', 'min', 'max', 'rarity'])
+
+_LOOT_TABLES = {}
+_RNG = {'rng': None, 'pid': None}
+
+# The monsters that drop each item, as lists of DropSource keyed by itemid, along with the modification times of the
+# loot table files it was built from and when they were last checked.
+_DROP_INDEX = {'index': None, 'mtimes': None, 'checked': 0}
+
 RARITY_NAMES = {
         1: 'always',
         16: 'common',
@@ -73,32 +101,32 @@ def get_attr(monsterid, key=NAME_KEY):
         raise KeyError
 
 
+def get_drop_sources(itemid):
+    """Gets the monsters that drop an item, as a list of DropSource in the order of MONSTERS."""
+    return list(_get_drop_index().get(str(int(itemid)), []))
+
+
 def get_loot_table(monsterid):
-    """Creates and returns a dictionary of possible loot from a monster given its id."""
-    loot_table = {}
-    with open(f'{MONSTER_DIRECTORY}{str(monsterid)}.txt') as f:
-        items = f.read().splitlines()
-    for item in items:
-        itemid, itemmin, itemmax, rarity = item.split(';')
-        loot_table[itemid] = {}
-        loot_table[itemid]['min'] = int(itemmin)
-        loot_table[itemid]['max'] = int(itemmax)
-        loot_table[itemid]['rarity'] = int(rarity)
-    return loot_table
+    """Returns a dictionary of possible loot from a monster given its id. This must not be changed, as it is shared by
+    every caller."""
+    return _get_compiled_loot_table(monsterid).table
 
 
 def get_loot(monsterid, num_to_kill, factor=1):
     """Generates a Counter from a number of killed monsters given its id."""
-    loot_table = get_loot_table(monsterid)
-    max_rarity = get_max_rarity(loot_table)
+    compiled = _get_compiled_loot_table(monsterid)
+    loot_table = compiled.table
     num_to_kill = int(num_to_kill)
+    draws = num_to_kill * round(8 * factor)
+    if numpy is not None and draws >= LOOT_BATCH_DRAWS:
+        return _get_loot_batched(compiled, num_to_kill, draws)
     loot = []
     for key in loot_table.keys():
         if loot_table[key]['rarity'] == 1:
             loot.extend([key] * num_to_kill)
     for _ in range(int(num_to_kill)):
         for _ in range(round(8 * factor)):
-            item = random.sample(loot_table.keys(), 1)[0]
+            item = random.choice(compiled.itemids)
             item_chance = loot_table[item]['rarity']
             if random.randint(1, item_chance) == 1 and int(item_chance) > 1:
                 item_min = loot_table[item]['min']
@@ -117,15 +145,20 @@ def get_max_rarity(loot_table):
     return max_rarity
 
 
+def get_rarity_name(rarity):
+    """Gets the name of the rarity tier a rarity value falls in."""
+    name = 1
+    for key in list(RARITY_NAMES.keys()):
+        if key <= rarity:
+            name = key
+        else:
+            break
+    return RARITY_NAMES[name]
+
+
 def get_rares(monster_name):
     monsterid = find_by_name(monster_name)
-    loottable = get_loot_table(monsterid)
-
-    rares = []
-    for item in list(loottable.keys()):
-        if int(loottable[item]['rarity']) >= 1024:
-            rares.append(item)
-    return rares
+    return list(_get_compiled_loot_table(monsterid).rares)
 
 
 def get_task_length(monsterid):
@@ -138,7 +171,7 @@ def get_task_length(monsterid):
 def get_random(check_for_key=None, slayer_level=1):
     """Randomly selects and returns a monster (given a particular boolean key)."""
     while True:
-        monsterid = random.sample(MONSTERS.keys(), 1)[0]
+        monsterid = random.choice(list(MONSTERS))
         if slayer_level >= get_attr(monsterid, key=SLAYER_REQ_KEY):
             if check_for_key is not None:
                 if MONSTERS[monsterid][check_for_key] is True:
@@ -149,29 +182,15 @@ def get_random(check_for_key=None, slayer_level=1):
 
 def print_item_from_lootable(item):
     out = '**Drop Sources**:\n'
-    for monsterid in list(MONSTERS.keys()):
-        loottable = get_loot_table(monsterid)
-        for itemid in list(loottable.keys()):
-            if int(itemid) == int(item):
-                name = MONSTERS[monsterid][NAME_KEY]
-                item_min = int(loottable[itemid]['min'])
-                item_max = int(loottable[itemid]['max'])
-                rarity = int(loottable[itemid]['rarity'])
-
-                out += f'{MONSTERS[monsterid][NAME_KEY].title()} *(amount: '
-
-                if item_min == item_max:
-                    out += f'{item_min}, '
-                else:
-                    out += f'{item_min}-{item_max}, '
-
-                for key in list(RARITY_NAMES.keys()):
-                    if key <= rarity:
-                        name = key
-                    else:
-                        break
-
-                out += f'rarity: {RARITY_NAMES[name]})*\n'
+    for source in get_drop_sources(item):
+        out += f'{MONSTERS[source.monsterid][NAME_KEY].title()} *(amount: '
+
+        if source.min == source.max:
+            out += f'{source.min}, '
+        else:
+            out += f'{source.min}-{source.max}, '
+
+        out += f'rarity: {get_rarity_name(source.rarity)})*\n'
     return out
 
 
@@ -220,21 +239,97 @@ def print_monster(monster):
         itemmin = int(loottable[item]['min'])
         itemmax = int(loottable[item]['max'])
         rarity = loottable[item]['rarity']
-        for key in list(RARITY_NAMES.keys()):
-            if key <= rarity:
-                name = key
-            else:
-                break
 
         out += f"{itemname} *(amount: "
         if itemmin == itemmax:
             out += f'{itemmin}, '
         else:
             out += f"{itemmin}-{itemmax}, "
-        out += f"rarity: {RARITY_NAMES[name]})*\n"
+        out += f"rarity: {get_rarity_name(rarity)})*\n"
 
         if len(out) >= 1800:
             messages.append(out)
             out = f'__**:skull_crossbones: BESTIARY :skull_crossbones:**__\n'
     messages.append(out)
     return messages
+
+
+def _get_drop_index():
+    """Gets the index of the monsters that drop each item, rebuilding it if any loot table file has changed. Like the
+    loot tables themselves, the files are checked at most once every LOOT_CHECK_INTERVAL seconds."""
+    now = time.monotonic()
+    if _DROP_INDEX['index'] is not None and now - _DROP_INDEX['checked'] < LOOT_CHECK_INTERVAL:
+        return _DROP_INDEX['index']
+    tables = [(monsterid, _get_compiled_loot_table(monsterid)) for monsterid in MONSTERS]
+    mtimes = [compiled.mtime for _, compiled in tables]
+    if mtimes != _DROP_INDEX['mtimes']:
+        index = {}
+        for monsterid, compiled in tables:
+            for itemid, entry in compiled.table.items():
+                source = DropSource(monsterid, entry['min'], entry['max'], entry['rarity'])
+                index.setdefault(str(int(itemid)), []).append(source)
+        _DROP_INDEX['index'] = index
+        _DROP_INDEX['mtimes'] = mtimes
+    _DROP_INDEX['checked'] = now
+    return _DROP_INDEX['index']
+
+
+def _get_loot_batched(compiled, num_to_kill, draws):
+    """Rolls loot the same way get_loot does, but with numpy and all at once. Each draw picks one item of the table at
+    random and drops it with a chance of one in its rarity, so the number of times each item drops over all the draws
+    is a single multinomial draw, and only the amount of each drop needs rolling separately."""
+    rng = _get_rng()
+    loot = Counter({itemid: num_to_kill for itemid in compiled.always})
+    drops = rng.multinomial(draws, compiled.drop_chances + (1 - sum(compiled.drop_chances),))
+    for itemid, count in zip(compiled.droppable, drops):
+        if count > 0:
+            entry = compiled.table[itemid]
+            amount = int(rng.integers(entry['min'], entry['max'] + 1, size=count).sum())
+            if amount > 0:
+                loot[itemid] += amount
+    return loot
+
+
+def _get_compiled_loot_table(monsterid):
+    """Gets a monster's loot table, reading its file only the first time or if the file has changed since."""
+    monsterid = str(monsterid)
+    path = f'{MONSTER_DIRECTORY}{monsterid}.txt'
+    now = time.monotonic()
+    compiled = _LOOT_TABLES.get(monsterid)
+    if compiled is not None and now - compiled.checked < LOOT_CHECK_INTERVAL:
+        return compiled
+    mtime = os.stat(path).st_mtime_ns
+    if compiled is not None and compiled.mtime == mtime:
+        compiled = compiled._replace(checked=now)
+    else:
+        compiled = _read_loot_table(path)._replace(mtime=mtime, checked=now)
+    _LOOT_TABLES[monsterid] = compiled
+    return compiled
+
+
+def _read_loot_table(path):
+    """Reads a loot table file into a LootTable."""
+    loot_table = {}
+    with open(path) as f:
+        items = f.read().splitlines()
+    for item in items:
+        itemid, itemmin, itemmax, rarity = item.split(';')
+        loot_table[itemid] = {}
+        loot_table[itemid]['min'] = int(itemmin)
+        loot_table[itemid]['max'] = int(itemmax)
+        loot_table[itemid]['rarity'] = int(rarity)
+    rares = tuple(itemid for itemid in loot_table if loot_table[itemid]['rarity'] >= 1024)
+    always = tuple(itemid for itemid in loot_table if loot_table[itemid]['rarity'] == 1)
+    droppable = tuple(itemid for itemid in loot_table if loot_table[itemid]['rarity'] > 1)
+    drop_chances = tuple(1 / (len(loot_table) * loot_table[itemid]['rarity']) for itemid in droppable)
+    return LootTable(loot_table, tuple(loot_table), get_max_rarity(loot_table), rares, always, droppable, drop_chances,
+                     None, None)
+
+
+def _get_rng():
+    """Gets numpy's random generator for this process. A new one is made in each worker process, as a forked process
+    would otherwise roll the same numbers as its parent."""
+    if _RNG['pid'] != os.getpid():
+        _RNG['rng'] = numpy.random.default_rng()
+        _RNG['pid'] = os.getpid()
+    return _RNG['rng']
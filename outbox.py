@@ -0,0 +1,80 @@
+"""This module contains the outbox that adventure results are sent to Discord through."""
+import asyncio
+import collections
+
+MAX_LENGTH = 2000   # The longest message Discord accepts.
+SEPARATOR = '\n\n'
+
+
+class Outbox:
+    """Queues messages for channels and sends them in the background, no faster than rate messages a second. Messages
+    waiting for the same channel are joined into as few messages of at most max_length characters as possible, so a
+    burst of results costs a handful of sends rather than one each.
+
+    send is any coroutine function taking a channel and a string, such as
+        lambda channel, content: channel.send(content)
+    Channels are only used as dictionary keys and passed back to send."""
+
+    def __init__(self, send, rate=1, max_length=MAX_LENGTH):
+        self.send = send
+        self.interval = 1 / rate
+        self.max_length = max_length
+        self._pending = collections.OrderedDict()
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def __len__(self):
+        return sum(len(messages) for messages in self._pending.values())
+
+    def put(self, channel, message, on_sent=None):
+        """Queues a message to be sent to a channel. This never waits. on_sent, if given, is called with no arguments
+        once the whole message has been sent."""
+        self._pending.setdefault(channel, collections.deque()).append((message, on_sent))
+        self._idle.clear()
+        self._wake.set()
+
+    async def drain(self):
+        """Waits until every queued message has been sent."""
+        await self._idle.wait()
+
+    async def run(self):
+        """Sends queued messages until cancelled. Channels take turns, one message each."""
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._pending:
+                channel, messages = self._pending.popitem(last=False)
+                content, callbacks = self._take(messages)
+                if messages:
+                    self._pending[channel] = messages
+                try:
+                    await self.send(channel, content)
+                except Exception as e:
+                    print(f'Could not send message to {channel}: {e!r}')
+                else:
+                    for callback in callbacks:
+                        callback()
+                await asyncio.sleep(self.interval)
+            self._idle.set()
+
+    def _take(self, messages):
+        """Removes as many of the oldest messages as fit in one message, and returns them joined together along with
+        the on_sent callbacks of the messages it completes. A message that is too long by itself is split at the last
+        line break that fits."""
+        content, on_sent = messages.popleft()
+        if len(content) > self.max_length:
+            cut = content.rfind('\n', 0, self.max_length)
+            if cut <= 0:
+                cut = self.max_length
+            rest = content[cut:].lstrip('\n')
+            if rest:
+                messages.appendleft((rest, on_sent))
+                return content[:cut], []
+            return content[:cut], [on_sent] if on_sent is not None else []
+        callbacks = [on_sent]
+        while messages and len(content) + len(SEPARATOR) + len(messages[0][0]) <= self.max_length:
+            message, on_sent = messages.popleft()
+            content += SEPARATOR + message
+            callbacks.append(on_sent)
+        return content, [callback for callback in callbacks if callback is not None]
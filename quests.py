@@ -3,9 +3,10 @@ import ujson
 import math
 
 from subs.miniscape import adventures as adv
+from subs.miniscape import combat
 from subs.miniscape import users
 from subs.miniscape import items
-from subs.miniscape.files import QUESTS_JSON
+from subs.miniscape.files import EAGER_RESULTS, QUESTS_JSON
 
 with open(QUESTS_JSON, 'r') as f:
     QUESTS = ujson.load(f)
@@ -43,42 +44,21 @@ DEFAULT_QUEST = {
 QUEST_HEADER = ':crossed_swords: __**QUESTS**__ :shield:\n'
 
 
-def calc_chance(userid, questid):
+def calc_chance(userid, questid, player=None):
     """Calculates the chance of success of a quest."""
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_arm = users.get_equipment_stats(equipment)[2]
-    monster_acc = get_attr(questid, key=ACCURACY_KEY)
-    monster_dam = get_attr(questid, key=DAMAGE_KEY)
-    monster_combat = get_attr(questid, key=LEVEL_KEY)
-    player_combat = users.xp_to_level(users.read_user(userid, key=users.SLAYER_XP_KEY))
-    if get_attr(questid, key=DRAGON_KEY) and '266' not in equipment:
-        monster_base = 100
-    else:
-        monster_base = 1
-
-    c = 1 + monster_combat / 200
-    d = player_combat / 200
-    dam_multiplier = monster_base + monster_acc / 200
+    if player is None:
+        player = combat.get_player_stats(userid)
+    return combat.calc_chance(player, get_attr(questid, key=LEVEL_KEY), get_attr(questid, key=ACCURACY_KEY),
+                              get_attr(questid, key=DAMAGE_KEY), get_attr(questid, key=DRAGON_KEY))
 
-    chance = round(min(100 * max(0, (player_arm / (monster_dam * dam_multiplier + c)) / 2 + d), 100))
-    return chance
 
-
-def calc_length(userid, questid):
+def calc_length(userid, questid, player=None):
     """Calculates the length of success of a quest."""
-    combat_level = users.xp_to_level(users.read_user(userid, key=users.COMBAT_XP_KEY))
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_dam, player_acc, player_arm = users.get_equipment_stats(equipment)
-    monster_arm = get_attr(questid, key=ARMOUR_KEY)
+    if player is None:
+        player = combat.get_player_stats(userid)
     base_time = 60 * get_attr(questid, key=TIME_KEY)
-    if get_attr(questid, key=DRAGON_KEY) and '266' not in equipment:
-        monster_base = 100
-    else:
-        monster_base = 1
-
-    c = combat_level
-    dam_multiplier = 1 + player_acc / 200
-    time = round(base_time * (monster_arm * monster_base / (player_dam * dam_multiplier + c)))
+    ratio = combat.calc_length_ratio(player, get_attr(questid, key=ARMOUR_KEY), get_attr(questid, key=DRAGON_KEY))
+    time = round(base_time * ratio)
     if time < 0.5 * base_time:
         time = round(0.5 * base_time)
     if time > 2 * base_time:
@@ -86,12 +66,22 @@ def calc_length(userid, questid):
     return time
 
 
+def get_required_items(questid):
+    """Gets the items a quest takes from a user when it is started, as a list of itemids."""
+    required_items = get_attr(questid, key=ITEM_REQ_KEY)
+    loot = []
+    for item in required_items:
+        loot.extend(required_items[item] * [item])
+    return loot
+
+
 def has_item_reqs(userid, questid):
     """Checks if a user can do a quest based on based on whether they have the required items in their inventory."""
     item_reqs = get_attr(questid, key=ITEM_REQ_KEY)
+    inventory = users.read_user(userid, key=users.ITEMS_KEY)
     count = 0
     for itemid in item_reqs:
-        if users.item_in_inventory(userid, itemid, item_reqs[itemid]):
+        if inventory.get(str(itemid), 0) >= item_reqs[itemid]:
             count += 1
     return count == len(item_reqs)
 
@@ -116,16 +106,18 @@ def get_attr(questid, key=NAME_KEY):
         raise KeyError
 
 
-def get_result(person, *args):
-    """Gets the result of a quest."""
+def get_result(person, *args, result=None):
+    """Gets the result of a quest, unless it was rolled when the quest started."""
     try:
         questid, chance = args[0]
     except ValueError as e:
         print(e)
         raise ValueError
 
+    if result is None:
+        result = roll_result(person.id, questid)
     out = f'{QUEST_HEADER}**{person.mention}, here is the result of your quest, {get_attr(questid)}**:\n'
-    if adv.is_success(calc_chance(person.id, questid)):
+    if result['success']:
         out += f'*{get_attr(questid, key=SUCCESS_KEY)}*\n\n'
         reward = get_attr(questid, key=REWARD_KEY)
         out += f'**Reward**:\n'
@@ -133,8 +125,9 @@ def get_result(person, *args):
         for itemid in reward:
             loot.extend(reward[itemid] * [itemid])
             out += f'{reward[itemid]} {items.get_attr(itemid)}\n'
-        users.update_inventory(person.id, loot)
-        users.update_user(person.id, questid, key=users.QUESTS_KEY)
+        with users.Changeset(person.id) as changes:
+            changes.add_items(loot)
+            changes.complete_quest(questid)
     else:
         out += f'*{get_attr(questid, key=FAILURE_KEY)}*'
     return out
@@ -183,12 +176,14 @@ def print_details(userid, questid):
 def print_list(userid):
     """Lists quests a user can do at the moment."""
     out = f'{QUEST_HEADER}'
-    for questid in list(QUESTS.keys()):
+    model = combat.evaluate(combat.get_player_stats(userid), combat.get_quest_stats())
+    completed_quests = set(users.get_completed_quests(userid))
+    for questid, chance in zip(model.ids, model.chance):
         if has_quest_reqs(userid, questid):
-            if int(questid) in set(users.get_completed_quests(userid)):
+            if int(questid) in completed_quests:
                 out += f'~~**{questid}**. {get_attr(questid)}~~\n'
             else:
-                out += f'**{questid}**. {get_attr(questid)}\n'
+                out += f'**{questid}**. {get_attr(questid)} *({chance}% chance)*\n'
     out += f'\n**Quests Completed**: {len(users.get_completed_quests(userid))}/{len(QUESTS.keys())}\n'
     out += 'Type `~quest [quest number]` to see more information about a quest.'
     return out
@@ -209,27 +204,51 @@ def print_status(time_left, *args):
     return out
 
 
+def is_started(userid, questid):
+    """Checks whether a user is on a quest or has it queued."""
+    try:
+        task = adv.get_adventure(userid)
+        if task.adventureid == adv.QUEST and int(task.args.questid) == int(questid):
+            return True
+    except NameError:
+        pass
+    return any(queued.adventureid == adv.QUEST and int(queued.args[0]) == int(questid)
+               for queued in adv.get_queue(userid))
+
+
+def refund_items(userid, questid):
+    """Gives back the items a quest took from a user when it was started."""
+    users.update_inventory(userid, get_required_items(questid))
+
+
+def roll_result(userid, questid):
+    """Rolls whether a quest succeeds."""
+    return {'success': adv.is_success(calc_chance(userid, questid))}
+
+
 def start_quest(userid, questid):
     """Assigns a user a slayer task provided they are not in the middle of another adventure."""
     out = QUEST_HEADER
-    if not adv.is_on_adventure(userid):
+    if not adv.is_queue_full(userid):
         try:
             name = get_attr(questid)
         except KeyError:
             return f"Error: 1uest number {questid} does not refer to any quest."
         if has_quest_reqs(userid, questid):
             if int(questid) not in set(users.get_completed_quests(userid)):
+                if is_started(userid, questid):
+                    return "Error: you are already doing or have already queued this quest."
                 if has_item_reqs(userid, questid):
-                    required_items = get_attr(questid, key=ITEM_REQ_KEY)
-                    loot = []
-                    for item in required_items:
-                        loot.extend(required_items[item] * [item])
-                    users.update_inventory(userid, loot, remove=True)
-                    chance = calc_chance(userid, questid)
-                    quest_length = calc_length(userid, questid)
-                    quest = adv.format_line(2, userid, adv.get_finish_time(quest_length), questid, chance)
-                    adv.write(quest)
-                    out += print_quest(questid, quest_length, chance)
+                    users.update_inventory(userid, get_required_items(questid), remove=True)
+                    player = combat.get_player_stats(userid)
+                    chance = calc_chance(userid, questid, player=player)
+                    quest_length = calc_length(userid, questid, player=player)
+                    result = roll_result(userid, questid) if EAGER_RESULTS else None
+                    position = adv.start(adv.QUEST, userid, quest_length, questid, chance, result=result)
+                    if position == 0:
+                        out += print_quest(questid, quest_length, chance)
+                    else:
+                        out += f'You will do the quest {name}. {adv.print_queued(position)}'
                 else:
                     return "Error: you do not have all the required items to start this quest."
             else:
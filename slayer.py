@@ -1,76 +1,63 @@
 import math
+import random
+from collections import Counter
 
+from subs.miniscape import combat
 from subs.miniscape import users
 from subs.miniscape import items
 from subs.miniscape import adventures as adv
 from subs.miniscape import monsters as mon
+from subs.miniscape.files import EAGER_RESULTS
 
 SLAYER_HEADER = ':skull_crossbones: __**SLAYER**__ :skull_crossbones:\n'
 
 
-def calc_chance(userid, monsterid, monster_stats=None):
+def calc_chance(userid, monsterid, monster_stats=None, player=None):
     """Calculates the chance of success of a task."""
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_arm = users.get_equipment_stats(equipment)[2]
-    monster_acc = mon.get_attr(monsterid, key=mon.ACCURACY_KEY)
-    monster_dam = mon.get_attr(monsterid, key=mon.DAMAGE_KEY)
-    monster_combat = mon.get_attr(monsterid, key=mon.LEVEL_KEY)
-    player_combat = users.xp_to_level(users.read_user(userid, key=users.SLAYER_XP_KEY))
-    if mon.get_attr(monsterid, key=mon.DRAGON_KEY) and '266' not in equipment:
-        monster_base = 100
-    else:
-        monster_base = 1
-
-    c = 1 + monster_combat / 200
-    d = player_combat / 200
-    dam_multiplier = monster_base + monster_acc / 200
+    if player is None:
+        player = combat.get_player_stats(userid)
+    return combat.calc_chance(player, mon.get_attr(monsterid, key=mon.LEVEL_KEY),
+                              mon.get_attr(monsterid, key=mon.ACCURACY_KEY),
+                              mon.get_attr(monsterid, key=mon.DAMAGE_KEY),
+                              mon.get_attr(monsterid, key=mon.DRAGON_KEY))
 
-    chance = round(min(100 * max(0, (player_arm / (monster_dam * dam_multiplier + c)) / 2 + d), 100))
-    return chance
 
-
-def calc_length(userid, monsterid, number):
+def calc_length(userid, monsterid, number, player=None):
     """Calculates the length of a task."""
-    combat_level = users.xp_to_level(users.read_user(userid, key=users.COMBAT_XP_KEY))
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_dam, player_acc, player_arm = users.get_equipment_stats(equipment)
-    monster_arm = mon.get_attr(monsterid, key=mon.ARMOUR_KEY)
+    if player is None:
+        player = combat.get_player_stats(userid)
     monster_xp = mon.get_attr(monsterid, key=mon.XP_KEY)
-    if mon.get_attr(monsterid, key=mon.DRAGON_KEY) and '266' not in equipment:
-        monster_base = 100
-    else:
-        monster_base = 1
-
-    c = combat_level
-    dam_multiplier = 1 + player_acc / 200
     base_time = math.floor(number * monster_xp / 10)
-    time = round(base_time * (monster_arm * monster_base / (player_dam * dam_multiplier + c)))
+    time = round(base_time * calc_length_ratio(player, monsterid))
     return base_time, time
 
 
+def calc_length_ratio(player, monsterid):
+    """Calculates how many times longer than its base time a task against a monster takes a user."""
+    return combat.calc_length_ratio(player, mon.get_attr(monsterid, key=mon.ARMOUR_KEY),
+                                    mon.get_attr(monsterid, key=mon.DRAGON_KEY))
+
+
 def calc_number(userid, monsterid, time):
     """Calculates the number of monsters that can be killed in a given time period."""
-    combat_level = users.xp_to_level(users.read_user(userid, key=users.COMBAT_XP_KEY))
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_dam, player_acc, player_arm = users.get_equipment_stats(equipment)
+    player = combat.get_player_stats(userid)
     monster_arm = mon.get_attr(monsterid, key=mon.ARMOUR_KEY)
     monster_xp = mon.get_attr(monsterid, key=mon.XP_KEY)
-    if mon.get_attr(monsterid, key=mon.DRAGON_KEY) and '266' not in equipment:
-        monster_base = 100
+    if mon.get_attr(monsterid, key=mon.DRAGON_KEY) and not player.anti_dragon:
+        monster_base = combat.DRAGONFIRE
     else:
         monster_base = 1
 
-    dam_multiplier = 1 + player_acc / 200
-
-    number = math.floor((10 * time * (player_dam * dam_multiplier + combat_level)) /
-                        (monster_arm * monster_base * monster_xp))
+    number = math.floor((10 * time * combat.calc_attack(player)) / (monster_arm * monster_base * monster_xp))
     return number
 
 
 def get_kill(userid, monster, length=-1, number=-1):
     """Lets the user start killing monsters.."""
     out = f'{SLAYER_HEADER}'
-    if not adv.is_on_adventure(userid):
+    if monster == 'GET_UPDATE':
+        return adv.print_adventure(userid)
+    if not adv.is_queue_full(userid):
         try:
             monsterid = mon.find_by_name(monster)
             length = int(length)
@@ -99,61 +86,67 @@ def get_kill(userid, monster, length=-1, number=-1):
             length = math.floor(calc_length(userid, monsterid, number)[1] / 60)
         else:
             return 'Error: argument missing (number or kill length).'
-        grind = adv.format_line(1, userid, adv.get_finish_time(length * 60), monsterid, monster_name, number, length)
-        adv.write(grind)
-        out += f'You are now killing {number} {mon.add_plural(monsterid)} for {length} minutes.'
+        result = roll_kill_result(monsterid, number) if EAGER_RESULTS else None
+        position = adv.start(adv.KILL, userid, length * 60, monsterid, monster_name, number, length, result=result)
+        if position == 0:
+            out += f'You are now killing {number} {mon.add_plural(monsterid)} for {length} minutes.'
+        else:
+            out += f'You will kill {number} {mon.add_plural(monsterid)} for {length} minutes. ' \
+                   f'{adv.print_queued(position)}'
     else:
         out = adv.print_adventure(userid)
         out += adv.print_on_adventure_error('kill')
     return out
 
 
-def get_kill_result(person, *args):
-    """Determines the loot of a monster grind."""
+def get_kill_result(person, *args, result=None):
+    """Determines the loot of a monster grind, unless it was rolled when the grind started."""
     try:
         monsterid, monster_name, num_to_kill, length = args[0]
     except ValueError as e:
         print(e)
         raise ValueError
     out = ''
-    if mon.get_attr(monsterid, key=mon.SLAYER_KEY):
-        factor = 0.75
-    else:
-        factor = 1
-    loot = mon.get_loot(monsterid, int(num_to_kill), factor=factor)
-    users.update_inventory(person.id, loot)
-    out += print_loot(loot, person, monster_name, num_to_kill)
+    if result is None:
+        result = roll_kill_result(monsterid, num_to_kill)
+    loot = Counter(result['loot'])
     xp_gained = mon.get_attr(monsterid, key=mon.XP_KEY) * int(num_to_kill)
-    users.update_user(person.id, xp_gained, users.COMBAT_XP_KEY)
+    with users.Changeset(person.id) as changes:
+        changes.add_items(loot)
+        changes.add_xp(xp_gained, users.COMBAT_XP_KEY)
+    out += print_loot(loot, person, monster_name, num_to_kill)
     combat_xp_formatted = '{:,}'.format(xp_gained)
     out += f'\nYou have also gained {combat_xp_formatted} combat xp.'
     return out
 
 
-def get_result(person, *args):
-    """Determines the success and loot of a slayer task."""
+def get_result(person, *args, result=None):
+    """Determines the success and loot of a slayer task, unless they were rolled when the task started."""
     try:
         monsterid, monster_name, num_to_kill, chance = args[0]
     except ValueError as e:
         print(e)
         raise ValueError
     out = ''
-    if adv.is_success(calc_chance(person.id, monsterid)):
-        loot = mon.get_loot(monsterid, int(num_to_kill))
-        users.update_inventory(person.id, loot)
-        out += print_loot(loot, person, monster_name, num_to_kill)
-
+    if result is None:
+        result = roll_result(person.id, monsterid, num_to_kill)
+    if result['success']:
+        loot = Counter(result['loot'])
         xp_gained = mon.get_attr(monsterid, key=mon.XP_KEY) * int(num_to_kill)
-        users.update_user(person.id, xp_gained, users.SLAYER_XP_KEY)
-        users.update_user(person.id, round(0.7 * xp_gained), users.COMBAT_XP_KEY)
+        with users.Changeset(person.id) as changes:
+            changes.add_items(loot)
+            changes.add_xp(xp_gained, users.SLAYER_XP_KEY)
+            changes.add_xp(round(0.7 * xp_gained), users.COMBAT_XP_KEY)
+        out += print_loot(loot, person, monster_name, num_to_kill)
 
         slayer_xp_formatted = '{:,}'.format(xp_gained)
         combat_xp_formatted = '{:,}'.format(round(0.7 * xp_gained))
         out += f'\nYou have also gained {slayer_xp_formatted} slayer xp and {combat_xp_formatted} combat xp.'
     else:
         xp_gained = round(mon.get_attr(monsterid, key=mon.XP_KEY) * int(num_to_kill) / 4)
-        users.update_user(person.id, xp_gained, users.SLAYER_XP_KEY)
-        users.update_user(person.id, round(0.7 * xp_gained), users.COMBAT_XP_KEY)
+        with users.Changeset(person.id) as changes:
+            changes.add_xp(xp_gained, users.SLAYER_XP_KEY)
+            changes.add_xp(round(0.7 * xp_gained), users.COMBAT_XP_KEY)
         slayer_xp_formatted = '{:,}'.format(xp_gained)
         combat_xp_formatted = '{:,}'.format(round(0.7 * xp_gained))
         out += f'{person.mention}, your slayer task of {num_to_kill} {mon.add_plural(monsterid)} has failed.\n'\
@@ -164,43 +157,72 @@ def get_result(person, *args):
 def get_task_info(userid):
     """Gets the info associated with a user's slayer task and returns it as a tuple."""
     task = adv.read(userid)
-    taskid, userid, finish_time, monsterid, monster_name, num_to_kill, chance = task
+    monsterid, monster_name, num_to_kill, chance = task.args
 
-    time_left = adv.get_delta(finish_time)
+    time_left = adv.get_delta(task.finish_time)
 
-    return taskid, userid, time_left, monsterid, monster_name, num_to_kill, chance
+    return task.adventureid, task.userid, time_left, monsterid, monster_name, num_to_kill, chance
 
 
 def get_task(userid):
     """Assigns a user a slayer task provided they are not in the middle of another adventure."""
     out = SLAYER_HEADER
-    if not adv.is_on_adventure(userid):
-        user_level = users.xp_to_level(users.read_user(userid, key=users.COMBAT_XP_KEY))
-        equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-        for _ in range(1000):
-            monsterid = mon.get_random(slayer_level=users.xp_to_level(users.read_user(userid, key=users.SLAYER_XP_KEY)))
-            num_to_kill = mon.get_task_length(monsterid)
-            base_time, task_length = calc_length(userid, monsterid, num_to_kill)
-            chance = calc_chance(userid, monsterid)
-            mon_level = mon.get_attr(monsterid, key=mon.LEVEL_KEY)
-            # print(f'{monsterid} {task_length/base_time} {chance}')
-            if 0.5 <= task_length / base_time <= 2 and chance >= 20 and mon_level / user_level >= 0.9\
-                    and mon.get_attr(monsterid, key=mon.SLAYER_KEY) is True:
-                break
-        else:
+    if not adv.is_queue_full(userid):
+        player = combat.get_player_stats(userid)
+        monsters = get_task_monsters(userid, player=player)
+        if not monsters:
             return "Error: gear too low to fight any monsters. Please equip some better gear and try again. " \
                    "If you are new, type `~starter` to get a bronze kit."
+        weights = [len(numbers) / (mon.get_attr(monsterid, key=mon.TASK_MAX_KEY) + 1
+                                   - mon.get_attr(monsterid, key=mon.TASK_MIN_KEY))
+                   for monsterid, numbers in monsters]
+        monsterid, numbers = random.choices(monsters, weights)[0]
+        num_to_kill = random.choice(numbers)
+        base_time, task_length = calc_length(userid, monsterid, num_to_kill, player=player)
+        chance = calc_chance(userid, monsterid, player=player)
         monster_name = mon.get_attr(monsterid)
-        task = adv.format_line(0, userid, adv.get_finish_time(task_length), monsterid,
-                               monster_name, num_to_kill, chance)
-        adv.write(task)
-        out += print_task(userid)
+        result = roll_result(userid, monsterid, num_to_kill) if EAGER_RESULTS else None
+        position = adv.start(adv.SLAYER_TASK, userid, task_length, monsterid, monster_name, num_to_kill, chance,
+                             result=result)
+        if position == 0:
+            out += print_task(userid)
+        else:
+            out += f'Your next task will be to kill {num_to_kill} {mon.add_plural(monsterid)}. ' \
+                   f'{adv.print_queued(position)}'
     else:
         out = adv.print_adventure(userid)
         out += adv.print_on_adventure_error('task')
     return out
 
 
+def get_task_monsters(userid, player=None):
+    """Gets the monsters a user can be given a slayer task for, as a list of (monsterid, numbers) where numbers are
+    how many of it the task could be to kill. These are slayable monsters within their slayer level, of at least 90%
+    of their combat level and that they have at least a 20% chance against, in numbers that would take them between
+    half and twice the base time to kill."""
+    if player is None:
+        player = combat.get_player_stats(userid)
+    model = combat.evaluate(player, combat.get_monster_stats())
+    monsters = []
+    for monsterid, chance, ratio in zip(model.ids, model.chance, model.ratio):
+        if chance < 20 \
+                or mon.get_attr(monsterid, key=mon.SLAYER_KEY) is not True \
+                or mon.get_attr(monsterid, key=mon.SLAYER_REQ_KEY) > player.slayer_level \
+                or mon.get_attr(monsterid, key=mon.LEVEL_KEY) / player.combat_level < 0.9:
+            continue
+        monster_xp = mon.get_attr(monsterid, key=mon.XP_KEY)
+        numbers = []
+        for number in range(mon.get_attr(monsterid, key=mon.TASK_MIN_KEY),
+                            mon.get_attr(monsterid, key=mon.TASK_MAX_KEY) + 1):
+            # The same rounding as calc_length, as it can bring a ratio just outside the limits back within them.
+            base_time = math.floor(number * monster_xp / 10)
+            if base_time > 0 and 0.5 <= round(base_time * ratio) / base_time <= 2:
+                numbers.append(number)
+        if numbers:
+            monsters.append((monsterid, numbers))
+    return monsters
+
+
 def print_loot(loot, person, monster_name, num_to_kill, add_mention=True):
     """Converts a user's loot from a slayer task to a string."""
     out = f'{SLAYER_HEADER}**'
@@ -225,26 +247,20 @@ def print_loot(loot, person, monster_name, num_to_kill, add_mention=True):
 
 
 def print_chance(userid, monsterid, monster_dam=-1, monster_acc=-1, monster_arm=-1, monster_combat=-1, xp=-1, number=100, dragonfire=False):
-    equipment = users.read_user(userid, key=users.EQUIPMENT_KEY)
-    player_dam, player_acc, player_arm = users.get_equipment_stats(equipment)
-    player_combat = users.xp_to_level(users.read_user(userid, key=users.SLAYER_XP_KEY))
+    # Dragonfire is given rather than read from the monster, and the player's slayer level stands in for their combat
+    # level throughout.
+    player = combat.get_player_stats(userid)
+    player = player._replace(combat_level=player.slayer_level, anti_dragon=False)
     if monster_dam == -1:
         monster_dam = mon.get_attr(monsterid, key=mon.DAMAGE_KEY)
         monster_acc = mon.get_attr(monsterid, key=mon.ACCURACY_KEY)
         monster_arm = mon.get_attr(monsterid, key=mon.ARMOUR_KEY)
         xp = mon.get_attr(monsterid, key=mon.XP_KEY)
         monster_combat = mon.get_attr(monsterid, key=mon.LEVEL_KEY)
-    if dragonfire:
-        monster_base = 100
-    else:
-        monster_base = 1
 
-    dam_multiplier = monster_base + monster_acc / 200
-    chance = round(min(100 * max(0, (player_arm / (monster_dam * dam_multiplier + 1 + monster_combat / 200)) / 2 + player_combat / 200), 100))
-
-    dam_multiplier = 1 + player_acc / 200
+    chance = combat.calc_chance(player, monster_combat, monster_acc, monster_dam, dragonfire)
     base_time = math.floor(number * xp / 10)
-    time = round(base_time * (monster_arm * monster_base / (player_dam * dam_multiplier + player_combat)))
+    time = round(base_time * combat.calc_length_ratio(player, monster_arm, dragonfire))
     out = f'level {monster_combat} monster with {monster_dam} dam {monster_acc} acc {monster_arm} arm giving {xp} xp: '\
           f'chance: {chance}%, base time: {base_time}, time to kill {number}: {time}, time ratio: {time / base_time}.'
     return out
@@ -275,3 +291,24 @@ def print_task(userid):
     out += f'This will take {task_length} minutes '
     out += f'and has a success rate of {chance}% with your current gear. '
     return out
+
+
+def roll_kill_result(monsterid, num_to_kill):
+    """Rolls the loot of a monster grind."""
+    if mon.get_attr(monsterid, key=mon.SLAYER_KEY):
+        factor = 0.75
+    else:
+        factor = 1
+    return {'loot': mon.get_loot(monsterid, int(num_to_kill), factor=factor)}
+
+
+def roll_result(userid, monsterid, num_to_kill):
+    """Rolls whether a slayer task succeeds and, if it does, its loot."""
+    if adv.is_success(calc_chance(userid, monsterid)):
+        return roll_success(monsterid, num_to_kill)
+    return {'success': False, 'loot': {}}
+
+
+def roll_success(monsterid, num_to_kill):
+    """Rolls the loot of a slayer task that has succeeded."""
+    return {'success': True, 'loot': mon.get_loot(monsterid, int(num_to_kill))}
@@ -0,0 +1,160 @@
+"""This module contains the client for the state server in stateserver.py. Each function here has the same signature
+as the function of the same name in users.py or adventures.py, and asks the server to run it instead. install()
+replaces those functions with these, so the rest of the game sends its changes to the server without knowing it."""
+import builtins
+import socket
+import threading
+import ujson
+
+from subs.miniscape import adventures as adv
+from subs.miniscape import users
+from subs.miniscape.files import STATE_SOCKET
+from subs.miniscape.inventory import Inventory
+
+_CONNECTION = {'path': STATE_SOCKET, 'socket': None, 'reader': None, 'next_id': 0}
+_LOCK = threading.Lock()
+
+
+def call(fn, *args, **kwargs):
+    """Runs a function on the server and returns its result, raising the same exception the function raised there.
+    Exceptions that are not built in are raised as a RuntimeError."""
+    with _LOCK:
+        if _CONNECTION['socket'] is None:
+            _connect()
+        _CONNECTION['next_id'] += 1
+        request = {'id': _CONNECTION['next_id'], 'fn': fn, 'args': args, 'kwargs': kwargs}
+        try:
+            _CONNECTION['socket'].sendall(ujson.dumps(request).encode() + b'\n')
+            line = _CONNECTION['reader'].readline()
+        except OSError:
+            _disconnect()
+            raise
+        if not line:
+            _disconnect()
+            raise ConnectionError('The state server closed the connection.')
+    reply = ujson.loads(line)
+    if 'error' in reply:
+        error = getattr(builtins, reply['error'], None)
+        if not (isinstance(error, type) and issubclass(error, Exception)):
+            error = RuntimeError
+        raise error(reply['message'])
+    return reply['result']
+
+
+def install(path=STATE_SOCKET):
+    """Replaces the functions in users.py and adventures.py that read or write the game files with ones that call
+    the server listening on path."""
+    _CONNECTION['path'] = path
+    for module, names in STUBS:
+        for name in names:
+            setattr(module, name, globals()[name])
+
+
+# users.py
+
+
+def apply_changes(userid, changes):
+    return call('users.apply_changes', userid, changes)
+
+
+def apply_many(changes):
+    return call('users.apply_many', changes)
+
+
+def clear_inventory(userid, under=None):
+    return call('users.clear_inventory', userid, under=under)
+
+
+def equip_item(userid, item):
+    return call('users.equip_item', userid, item)
+
+
+def item_in_inventory(userid, item, number=1):
+    return call('users.item_in_inventory', userid, item, number=number)
+
+
+def read_user(userid, key=users.ITEMS_KEY):
+    value = call('users.read_user', userid, key=key)
+    return Inventory.from_dict(value) if key == users.ITEMS_KEY else value
+
+
+def update_inventory(userid, loot, remove=False):
+    return call('users.update_inventory', userid, loot, remove=remove)
+
+
+def update_user(userid, value, key=users.ITEMS_KEY):
+    return call('users.update_user', userid, value, key=key)
+
+
+# adventures.py
+
+
+def add(adventureid, userid, finish_time, *args, result=None):
+    return call('adventures.add', adventureid, userid, finish_time, *args, result=result)
+
+
+def get_adventure(userid):
+    return adv.make_adventure(*call('adventures.get_adventure', userid))
+
+
+def get_finished():
+    return [adv.make_adventure(*adventure) for adventure in call('adventures.get_finished')]
+
+
+def get_list():
+    return [adv.make_adventure(*adventure) for adventure in call('adventures.get_list')]
+
+
+def get_queue(userid):
+    return [adv.Queued(*queued) for queued in call('adventures.get_queue', userid)]
+
+
+def get_seconds_until_next():
+    return call('adventures.get_seconds_until_next')
+
+
+def is_on_adventure(userid):
+    return call('adventures.is_on_adventure', userid)
+
+
+def is_queue_full(userid):
+    return call('adventures.is_queue_full', userid)
+
+
+def queue_length(userid):
+    return call('adventures.queue_length', userid)
+
+
+def read(userid):
+    return adv.make_adventure(*call('adventures.read', userid))
+
+
+def remove(userid):
+    return call('adventures.remove', userid)
+
+
+def start(adventureid, userid, length, *args, result=None):
+    return call('adventures.start', adventureid, userid, length, *args, result=result)
+
+
+STUBS = [(users, ['apply_changes', 'apply_many', 'clear_inventory', 'equip_item', 'item_in_inventory', 'read_user',
+                  'update_inventory', 'update_user']),
+         (adv, ['add', 'get_adventure', 'get_finished', 'get_list', 'get_queue', 'get_seconds_until_next',
+                'is_on_adventure', 'is_queue_full', 'queue_length', 'read', 'remove', 'start'])]
+
+
+def _connect():
+    """Opens the connection to the server."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(_CONNECTION['path'])
+    _CONNECTION['socket'] = connection
+    _CONNECTION['reader'] = connection.makefile('rb')
+
+
+def _disconnect():
+    """Closes the connection to the server, so the next call opens a new one."""
+    if _CONNECTION['socket'] is not None:
+        _CONNECTION['reader'].close()
+        _CONNECTION['socket'].close()
+    _CONNECTION['socket'] = None
+    _CONNECTION['reader'] = None
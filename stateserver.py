@@ -0,0 +1,92 @@
+"""This module contains a small server that owns the account and adventure files, so that several bot processes can
+share one game state. Clients connect over a Unix socket and send one JSON request per line:
+    {"id": 1, "fn": "users.read_user", "args": [1234], "kwargs": {"key": "combat"}}
+and get one JSON reply per line, either {"id": 1, "result": ...} or {"id": 1, "error": "NameError", "message": ...}.
+Calls are run one at a time, so each call is atomic with respect to every other client. It is started with
+    python -m subs.miniscape.stateserver [socket path]"""
+import asyncio
+import concurrent.futures
+import os
+import sys
+import ujson
+
+from subs.miniscape import adventures as adv
+from subs.miniscape import files
+from subs.miniscape import users
+from subs.miniscape import userstore
+
+# The functions clients may call. These are the ones that read or change the account and adventure files; everything
+# else in users.py and adventures.py is built from them and can run in the client.
+FUNCTIONS = {
+    'users.apply_changes': users.apply_changes,
+    'users.apply_many': users.apply_many,
+    'users.clear_inventory': users.clear_inventory,
+    'users.equip_item': users.equip_item,
+    'users.item_in_inventory': users.item_in_inventory,
+    'users.read_user': users.read_user,
+    'users.update_inventory': users.update_inventory,
+    'users.update_user': users.update_user,
+    'adventures.add': adv.add,
+    'adventures.get_adventure': adv.get_adventure,
+    'adventures.get_finished': adv.get_finished,
+    'adventures.get_list': adv.get_list,
+    'adventures.get_queue': adv.get_queue,
+    'adventures.get_seconds_until_next': adv.get_seconds_until_next,
+    'adventures.is_on_adventure': adv.is_on_adventure,
+    'adventures.is_queue_full': adv.is_queue_full,
+    'adventures.queue_length': adv.queue_length,
+    'adventures.read': adv.read,
+    'adventures.remove': adv.remove,
+    'adventures.start': adv.start,
+}
+
+
+def call(request):
+    """Runs a request and returns the reply to send back."""
+    reply = {'id': request.get('id')}
+    try:
+        function = FUNCTIONS[request['fn']]
+    except KeyError:
+        reply.update(error='KeyError', message=f"{request.get('fn')} cannot be called.")
+        return reply
+    try:
+        reply['result'] = function(*request.get('args', []), **request.get('kwargs', {}))
+    except Exception as e:
+        reply.update(error=type(e).__name__, message=str(e))
+    return reply
+
+
+async def handle(reader, writer, executor):
+    """Answers requests from one client until it disconnects."""
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            request = ujson.loads(line)
+        except ValueError:
+            reply = {'id': None, 'error': 'ValueError', 'message': 'Request is not valid JSON.'}
+        else:
+            reply = await loop.run_in_executor(executor, call, request)
+        writer.write(ujson.dumps(reply).encode() + b'\n')
+        await writer.drain()
+    writer.close()
+
+
+async def serve(path=files.STATE_SOCKET):
+    """Listens for clients on a Unix socket until cancelled."""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(lambda r, w: handle(r, w, executor), path=path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown()
+        userstore.flush()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(*sys.argv[1:]))
@@ -1,10 +1,14 @@
-import ujson
+import contextlib
+import copy
+import threading
 from collections import Counter
 
 from subs.gastercoin import account as ac
 
-from subs.miniscape.files import USERS_JSON, XP_FILE, ARMOUR_SLOTS_FILE
+from subs.miniscape.files import XP_FILE, ARMOUR_SLOTS_FILE
 from subs.miniscape import items
+from subs.miniscape import userstore
+from subs.miniscape.inventory import Inventory
 
 
 XP = {}
@@ -19,7 +23,7 @@ with open(ARMOUR_SLOTS_FILE, 'r') as f:
         line_split = line.split(';')
         SLOTS[line_split[0]] = line_split[1]
 
-ITEMS_KEY = 'items'             # User's inventory, stored as a Counter
+ITEMS_KEY = 'items'             # User's inventory, stored as an Inventory keyed by integer item id.
 EQUIPMENT_KEY = 'equip'         # User's equipment, stored as a list of size 13 initialized to -1.
 COMBAT_XP_KEY = 'combat'        # User's combat xp, stored as an int.
 SLAYER_XP_KEY = 'slayer'        # User's slayer xp, stored as an int.
@@ -27,7 +31,7 @@ GATHER_XP_KEY = 'gather'        # User's gathering xp, stored as an int.
 ARTISAN_XP_KEY = 'artisan'      # User's artisan xp, stored as an int.
 QUESTS_KEY = 'quests'           # User's complted quest. Storted as a hexidecimal number whose bits represent
                                 # whether a user has completed a quest with that questid.
-DEFAULT_ACCOUNT = {ITEMS_KEY: Counter(),
+DEFAULT_ACCOUNT = {ITEMS_KEY: Inventory(),
                    EQUIPMENT_KEY: [-1]*13,
                    COMBAT_XP_KEY: 0,
                    SLAYER_XP_KEY: 0,
@@ -35,19 +39,144 @@ DEFAULT_ACCOUNT = {ITEMS_KEY: Counter(),
                    ARTISAN_XP_KEY: 0,
                    QUESTS_KEY: "0x0"}
 
+ADD_OPERATION = 'add'           # Adds to a user's xp, or adds (or with negative numbers, removes) inventory items.
+SET_OPERATION = 'set'           # Replaces the value of a key.
+QUEST_OPERATION = 'quest'       # Marks a quest as completed.
+COINS_OPERATION = 'coins'       # Changes the user's GasterCoin balance, which is kept outside of their account.
+
+# Changesets committed inside batch() are held here, per thread, until the batch ends.
+_BATCH = threading.local()
+
+
+class Changeset:
+    """Collects changes to a user's account so they can all be applied with one read and one write of the account.
+    When used as a context manager, the changes are applied once the block exits without an exception. Inside batch(),
+    they are applied when the batch ends instead."""
+
+    def __init__(self, userid):
+        self.userid = userid
+        self.changes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def add_coins(self, amount):
+        """Adds (or with a negative amount, removes) GasterCoin from the user."""
+        self.changes.append((COINS_OPERATION, None, amount))
+
+    def add_items(self, loot):
+        """Adds a list or Counter of items to the user's inventory."""
+        self.changes.append((ADD_OPERATION, ITEMS_KEY, dict(Counter(loot))))
+
+    def add_xp(self, xp, key):
+        """Adds xp to one of the user's skills."""
+        self.changes.append((ADD_OPERATION, key, xp))
+
+    def commit(self):
+        """Applies and clears the collected changes."""
+        pending = getattr(_BATCH, 'changes', None)
+        if pending is not None:
+            pending.setdefault(self.userid, []).extend(self.changes)
+        else:
+            apply_changes(self.userid, self.changes)
+        self.changes = []
+
+    def complete_quest(self, questid):
+        """Marks a quest as completed by the user."""
+        self.changes.append((QUEST_OPERATION, QUESTS_KEY, questid))
+
+    def remove_items(self, loot):
+        """Removes a list or Counter of items from the user's inventory."""
+        self.changes.append((ADD_OPERATION, ITEMS_KEY, {itemid: -number for itemid, number in Counter(loot).items()}))
+
+    def set(self, key, value):
+        """Replaces the value of a key within the user's account."""
+        self.changes.append((SET_OPERATION, key, value))
+
+
+def apply_changes(userid, changes):
+    """Applies a list of (operation, key, value) changes to a user's account with a single read and write. If any
+    change cannot be made (i.e. removing items the user does not have), a ValueError is raised and nothing is changed.
+    GasterCoin is only added or removed once the account itself has been written."""
+    store = userstore.get_store()
+    account, coins = _changed_account(userid, store.get(userid), changes)
+    store.put(userid, account)
+    if coins != 0:
+        ac.update_account(userid, coins)
+
+
+def apply_many(changes):
+    """Applies lists of changes to several accounts, given as (userid, changes) pairs, with a single write of the
+    store. A user whose changes cannot be made is left unchanged, and the rest are still applied. Returns the userids
+    of the users that were left unchanged."""
+    store = userstore.get_store()
+    accounts = []
+    coins = []
+    skipped = []
+    for userid, user_changes in changes:
+        try:
+            account, user_coins = _changed_account(userid, store.get(userid), user_changes)
+        except ValueError as e:
+            print(e)
+            skipped.append(userid)
+            continue
+        accounts.append((userid, account))
+        coins.append((userid, user_coins))
+    store.put_many(accounts)
+    for userid, user_coins in coins:
+        if user_coins != 0:
+            ac.update_account(userid, user_coins)
+    return skipped
+
+
+@contextlib.contextmanager
+def batch():
+    """Holds back every Changeset committed by this thread inside the block, then applies them all with apply_many()
+    when it exits, so that many users' changes cost one write of the store rather than one each. The list it gives is
+    filled with the userids of the users whose changes could not be made once the batch ends. A batch inside another
+    is applied by the outer one, so its list is left empty."""
+    skipped = []
+    if getattr(_BATCH, 'changes', None) is not None:
+        yield skipped
+        return
+    _BATCH.changes = {}
+    try:
+        yield skipped
+    finally:
+        changes, _BATCH.changes = _BATCH.changes, None
+        skipped.extend(apply_many(list(changes.items())))
+
+
+def discard_batched(userid):
+    """Drops the changes to a user's account that have been committed inside this thread's batch() but not yet
+    applied."""
+    pending = getattr(_BATCH, 'changes', None)
+    if pending is not None:
+        for key in [key for key in pending if str(key) == str(userid)]:
+            del pending[key]
+
 
 def clear_inventory(userid, under=None):
-    """Removes all items (with value) in an account's inventory."""
+    """Sells all items (with value) in an account's inventory and returns the GasterCoin they were sold for."""
     if under is not None:
         max_sell = int(under)
     else:
         max_sell = 2147483647
     inventory = read_user(userid, ITEMS_KEY)
+    sold = Counter()
     for itemid in list(inventory.keys()):
         value = items.get_attr(itemid, key=items.VALUE_KEY)
         if inventory[itemid] > 0 and 0 < value < max_sell:
-            inventory[itemid] = 0
-    update_user(userid, inventory, key=ITEMS_KEY)
+            sold[itemid] = inventory[itemid]
+    total_value = get_value_of_inventory(sold)
+    with Changeset(userid) as changes:
+        changes.remove_items(sold)
+        changes.add_coins(total_value)
+    return total_value
 
 
 def equip_item(userid, item):
@@ -65,13 +194,12 @@ def equip_item(userid, item):
             slot = items.get_attr(itemid, key=items.SLOT_KEY)
             if slot > 0:
                 equipment = read_user(userid, key=EQUIPMENT_KEY)
-                if equipment[slot] == -1:
-                    equipment[slot] = itemid
-                else:
-                    update_inventory(userid, [equipment[slot]])
+                with Changeset(userid) as changes:
+                    if equipment[slot] != -1:
+                        changes.add_items([equipment[slot]])
                     equipment[slot] = itemid
-                update_inventory(userid, [itemid], remove=True)
-                update_user(userid, equipment, EQUIPMENT_KEY)
+                    changes.remove_items([itemid])
+                    changes.set(EQUIPMENT_KEY, equipment)
                 return f'{item_name} equipped to {SLOTS[str(slot)]}!'
             else:
                 return f'Error: {item_name} cannot be equipped.'
@@ -122,18 +250,15 @@ def get_value_of_inventory(inventory, under=None):
 
 def item_in_inventory(userid, item, number=1):
     """Determines whether (a given number of) an item is in a user's inventory."""
-    with open(USERS_JSON, 'r') as f:
-        accounts = ujson.load(f)
-
-    userid = str(userid)
+    account = userstore.get_store().get(userid)
 
     try:
-        count = accounts[userid][ITEMS_KEY][item]
+        count = account[ITEMS_KEY][str(item)]
         if count >= number:
             return True
         else:
             return False
-    except KeyError:
+    except (KeyError, TypeError):
         return False
 
 
@@ -203,62 +328,36 @@ def print_inventory(userid, search):
 
 def read_user(userid, key=ITEMS_KEY):
     """Reads the value of a key within a user's account."""
-    userid = str(userid)
     try:
-        with open(USERS_JSON, 'r') as f:
-            accounts = ujson.load(f)
-        if userid not in accounts:
-            accounts[userid] = DEFAULT_ACCOUNT
-        if key not in accounts[userid].keys():
-            accounts[userid][key] = DEFAULT_ACCOUNT[key]
-            with open(USERS_JSON, 'w') as f:
-                ujson.dump(accounts, f)
-        return accounts[userid][key]
+        account = userstore.get_store().get(userid)
+        if account is None:
+            return copy.deepcopy(DEFAULT_ACCOUNT[key])
+        # Callers are free to modify what they read, so they get a copy rather than what the store may have cached.
+        if key == ITEMS_KEY:
+            return Inventory.from_dict(account.get(key, DEFAULT_ACCOUNT[key]))
+        return copy.deepcopy(account.get(key, DEFAULT_ACCOUNT[key]))
     except KeyError:
         return 0
 
 
 def update_inventory(userid, loot, remove=False):
     """Adds or removes items from a user's inventory."""
-    with open(USERS_JSON, 'r') as f:
-        accounts = ujson.load(f)
-    try:
-        inventory = Counter(accounts[str(userid)]['items'])
-        loot = Counter(loot)
-        inventory = inventory - loot if remove else inventory + loot
-        accounts[str(userid)]['items'] = inventory
-    except KeyError:
+    with Changeset(userid) as changes:
         if remove:
-            raise ValueError
+            changes.remove_items(loot)
         else:
-            accounts[str(userid)] = {}
-            accounts[str(userid)]['items'] = Counter(loot)
-    with open(USERS_JSON, 'w') as f:
-        ujson.dump(accounts, f)
+            changes.add_items(loot)
 
 
 def update_user(userid, value, key=ITEMS_KEY):
     """Changes the value of a key within a user's account."""
-    userid = str(userid)
-    with open(USERS_JSON, 'r') as f:
-        accounts = ujson.load(f)
-
-    if userid not in accounts:
-        accounts[userid] = DEFAULT_ACCOUNT
-    if key not in accounts[userid].keys():
-        accounts[userid][key] = DEFAULT_ACCOUNT[key]
-    if key == COMBAT_XP_KEY or key == SLAYER_XP_KEY or key == GATHER_XP_KEY or key == ARTISAN_XP_KEY:
-        current_xp = accounts[userid][key]
-        accounts[userid][key] = current_xp + value
-    elif key == EQUIPMENT_KEY or key == ITEMS_KEY:
-        accounts[userid][key] = value
-    elif key == QUESTS_KEY:
-        current_quests = int(str(accounts[userid][key])[2:], 16)
-        current_quests = current_quests | 1 << (int(value) - 1)
-        accounts[userid][key] = str(hex(current_quests))
-
-    with open(USERS_JSON, 'w') as f:
-        ujson.dump(accounts, f)
+    with Changeset(userid) as changes:
+        if key == COMBAT_XP_KEY or key == SLAYER_XP_KEY or key == GATHER_XP_KEY or key == ARTISAN_XP_KEY:
+            changes.add_xp(value, key)
+        elif key == EQUIPMENT_KEY or key == ITEMS_KEY:
+            changes.set(key, value)
+        elif key == QUESTS_KEY:
+            changes.complete_quest(value)
 
 
 def xp_to_level(xp):
@@ -268,3 +367,32 @@ def xp_to_level(xp):
             return int(XP[level_xp]) - 1
     else:
         return 99
+
+
+def _changed_account(userid, account, changes):
+    """Gets a copy of an account with a list of changes applied, and the GasterCoin the changes add or remove."""
+    account = copy.deepcopy(DEFAULT_ACCOUNT if account is None else account)
+    coins = 0
+    for operation, key, value in changes:
+        if operation == COINS_OPERATION:
+            coins += value
+            continue
+        if key not in account.keys():
+            account[key] = copy.deepcopy(DEFAULT_ACCOUNT[key])
+        if operation == ADD_OPERATION and key == ITEMS_KEY:
+            inventory = Inventory.from_dict(account[key])
+            for itemid, number in value.items():
+                if inventory.add(itemid, number) < 0:
+                    raise ValueError(f'{userid} does not have {-number} of item {itemid}.')
+            account[key] = inventory
+        elif operation == ADD_OPERATION:
+            account[key] += value
+        elif operation == SET_OPERATION and key == ITEMS_KEY:
+            account[key] = Inventory.from_dict(value)
+        elif operation == SET_OPERATION:
+            account[key] = value
+        elif operation == QUEST_OPERATION:
+            current_quests = int(str(account[key])[2:], 16)
+            current_quests = current_quests | 1 << (int(value) - 1)
+            account[key] = str(hex(current_quests))
+    return account, coins
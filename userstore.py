@@ -0,0 +1,460 @@
+"""This module contains the backends that user accounts are stored in."""
+import atexit
+import os
+import sqlite3
+import threading
+import ujson
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from subs.miniscape.files import USERS_BACKEND, USERS_DB, USERS_DIRECTORY, USERS_JOURNAL, USERS_JSON, USERS_MSGPACK
+from subs.miniscape.inventory import Inventory
+
+COMPACT_EVERY = 1000        # Number of journal records written before the journal is compacted into a snapshot.
+FLUSH_DELAY = 0.5           # Seconds the JSON backend waits to gather further changes before writing them out.
+SHARDS = 256                # Number of files a new sharded store spreads its accounts over.
+ITEMS_KEY = 'items'         # Same as users.ITEMS_KEY. The journal records inventories item by item.
+QUESTS_KEY = 'quests'       # Same as users.QUESTS_KEY. The binary format stores quests as an int, not a hex string.
+
+# Every backend stores an account as a dictionary keyed by the keys in users.py, and exposes the same methods:
+# get(userid), put(userid, account), put_many(accounts), items() and flush(), where put_many takes (userid, account)
+# pairs and writes them all at once. An inventory may be an Inventory or an {'itemid': number} dictionary: the JSON
+# file backends leave inventories as the dictionaries they were read as, since converting every account in the file
+# costs more than it saves, and users.py converts them as they are read or changed. The other backends load them as
+# Inventory objects. Inventories are written to JSON by ujson through Inventory.toDict(). Backends may be used from
+# several threads at once, so each guards its own state with a lock; keeping two changes to the same account from
+# interleaving is left to the caller.
+_STORE = {'store': None}
+
+
+class FileStore:
+    """Stores every account in a single file, which is parsed once and cached until it changes on disk. The file is
+    written in one of the formats in CODECS, JSON by default.
+
+    Changes are made to the cached accounts straight away, but are only written to the file once FLUSH_DELAY seconds
+    have passed since the first unwritten change, so a burst of changes costs a single write. The file is replaced
+    with a rename, so other readers never see it half-written."""
+
+    def __init__(self, path, codec='json'):
+        self.path = path
+        self.decode, self.encode = CODECS[codec]
+        self._accounts = None
+        self._stat = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def flush(self):
+        """Writes any changes that have not been written yet to the accounts file."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty:
+                _atomic_write(self.path, self.encode(self._accounts))
+                self._stat = _file_stat(self.path)
+                self._dirty = False
+
+    def get(self, userid):
+        """Gets a user's account, or None if they do not have one."""
+        with self._lock:
+            return self._load().get(str(userid))
+
+    def items(self):
+        """Gets a list of (userid, account) pairs for every account."""
+        with self._lock:
+            return list(self._load().items())
+
+    def put(self, userid, account):
+        """Replaces a user's account, and schedules a flush if one is not already scheduled."""
+        with self._lock:
+            accounts = self._load()
+            accounts[str(userid)] = account
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def put_many(self, accounts):
+        """Replaces a number of accounts and writes them out with a single write of the accounts file."""
+        with self._lock:
+            for userid, account in accounts:
+                self.put(userid, account)
+            self.flush()
+
+    def _load(self):
+        """Gets every account, only reading the accounts file if it has changed since it was last read. Unwritten
+        changes are newer than anything on disk, so the file is never reread while there are any."""
+        stat = _file_stat(self.path)
+        if self._accounts is None or (not self._dirty and self._stat != stat):
+            if stat is None:
+                self._accounts = {}
+            else:
+                with open(self.path, 'rb') as f:
+                    self._accounts = self.decode(f.read())
+            self._stat = stat
+        return self._accounts
+
+
+class JournalStore:
+    """Stores accounts as a snapshot file plus a journal of the changes made since it was written. A change appends
+    one short record to the journal, and every COMPACT_EVERY records the journal is folded into a new snapshot.
+
+    A record holds the new values of whatever changed in one account, e.g. {"u": "1", "items": {"291": 3},
+    "set": {"slayer": 450}}. Replaying a record twice gives the same result, so a crash while compacting (after the
+    snapshot is written but before the journal is emptied) loses nothing."""
+
+    def __init__(self, snapshot_path, journal_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self._accounts = None
+        self._snapshot_stat = None
+        self._offset = 0
+        self._records = 0
+        self._lock = threading.RLock()
+
+    def flush(self):
+        """Does nothing, as every change is appended to the journal as soon as it is made."""
+        pass
+
+    def get(self, userid):
+        """Gets a user's account, or None if they do not have one."""
+        with self._lock:
+            return self._load().get(str(userid))
+
+    def items(self):
+        """Gets a list of (userid, account) pairs for every account."""
+        with self._lock:
+            return list(self._load().items())
+
+    def put(self, userid, account):
+        """Replaces a user's account by appending the fields that changed to the journal."""
+        self.put_many([(userid, account)])
+
+    def put_many(self, accounts):
+        """Replaces a number of accounts with a single append to the journal."""
+        with self._lock:
+            stored = self._load()
+            lines = []
+            for userid, account in accounts:
+                userid = str(userid)
+                record = _diff_account(stored.get(userid), account)
+                stored[userid] = account
+                if record is not None:
+                    lines.append((ujson.dumps({'u': userid, **record}) + '\n').encode())
+            if not lines:
+                return
+            data = b''.join(lines)
+            with open(self.journal_path, 'ab') as f:
+                f.write(data)
+            self._offset += len(data)
+            self._records += len(lines)
+            if self._records >= COMPACT_EVERY:
+                self.compact()
+
+    def compact(self):
+        """Writes every account to a new snapshot and empties the journal."""
+        with self._lock:
+            accounts = self._load()
+            _atomic_dump(self.snapshot_path, accounts)
+            open(self.journal_path, 'wb').close()
+            self._snapshot_stat = _file_stat(self.snapshot_path)
+            self._offset = 0
+            self._records = 0
+
+    def _load(self):
+        """Gets every account, replaying any part of the journal that has not been read yet."""
+        snapshot_stat = _file_stat(self.snapshot_path)
+        journal_stat = _file_stat(self.journal_path)
+        journal_size = journal_stat[1] if journal_stat is not None else 0
+        if self._accounts is None or self._snapshot_stat != snapshot_stat or journal_size < self._offset:
+            if snapshot_stat is None:
+                self._accounts = {}
+            else:
+                with open(self.snapshot_path, 'rb') as f:
+                    self._accounts = _decode_json(f.read())
+            self._snapshot_stat = snapshot_stat
+            self._offset = 0
+            self._records = 0
+            self._replay(recover=True)
+        elif journal_size > self._offset:
+            self._replay()
+        return self._accounts
+
+    def _replay(self, recover=False):
+        """Applies the journal records after the current offset. When recovering, a partly written record left at
+        the end of the journal by a crash is cut off so that later records are not appended onto it."""
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            record = ujson.loads(line)
+            account = self._accounts.setdefault(record['u'], {})
+            account.update(record.get('set', {}))
+            for itemid, number in record.get(ITEMS_KEY, {}).items():
+                inventory = account.setdefault(ITEMS_KEY, Inventory())
+                if number != 0:
+                    inventory[itemid] = number
+                elif itemid in inventory:
+                    del inventory[itemid]
+            self._records += 1
+        self._offset += end
+        if recover and end < len(data):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(self._offset)
+
+
+class ShardedStore:
+    """Spreads accounts over a number of JSON files in a directory by userid, so a change to one account only reads
+    and writes the file it is in. The directory's index records how many shards there are, so that the same user is
+    always looked up in the same shard. Each shard is a FileStore, and is only read the first time it is used."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        index_path = f'{directory}index.json'
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.index = ujson.load(f)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.index = {'shards': SHARDS}
+            _atomic_dump(index_path, self.index)
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """Writes any changes that have not been written yet to their shards."""
+        for shard in list(self._shards.values()):
+            shard.flush()
+
+    def get(self, userid):
+        """Gets a user's account, or None if they do not have one."""
+        return self._shard(userid).get(userid)
+
+    def items(self):
+        """Gets a list of (userid, account) pairs for every account."""
+        accounts = []
+        for number in range(self.index['shards']):
+            accounts.extend(self._shard_by_number(number).items())
+        return accounts
+
+    def put(self, userid, account):
+        """Replaces a user's account."""
+        self._shard(userid).put(userid, account)
+
+    def put_many(self, accounts):
+        """Replaces a number of accounts, writing each shard once."""
+        for userid, account in accounts:
+            self.put(userid, account)
+        self.flush()
+
+    def _shard(self, userid):
+        """Gets the shard holding a user's account."""
+        userid = str(userid)
+        key = int(userid) if userid.isdigit() else zlib.crc32(userid.encode())
+        return self._shard_by_number(key % self.index['shards'])
+
+    def _shard_by_number(self, number):
+        """Gets a shard from its number, opening it if it has not been used yet."""
+        with self._lock:
+            if number not in self._shards:
+                self._shards[number] = FileStore(f'{self.directory}{number}.json')
+            return self._shards[number]
+
+
+class SqliteStore:
+    """Stores each account as its own row in an SQLite database, so a change only rewrites that user's row."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS accounts (userid TEXT PRIMARY KEY, account TEXT NOT NULL)')
+
+    def flush(self):
+        """Does nothing, as every change is committed as soon as it is made."""
+        pass
+
+    def get(self, userid):
+        """Gets a user's account, or None if they do not have one."""
+        with self._lock:
+            row = self._conn.execute('SELECT account FROM accounts WHERE userid = ?', (str(userid),)).fetchone()
+        return _load_inventory(ujson.loads(row[0])) if row is not None else None
+
+    def items(self):
+        """Gets a list of (userid, account) pairs for every account."""
+        with self._lock:
+            rows = self._conn.execute('SELECT userid, account FROM accounts').fetchall()
+        return [(userid, _load_inventory(ujson.loads(account))) for userid, account in rows]
+
+    def put(self, userid, account):
+        """Replaces a user's account."""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO accounts (userid, account) VALUES (?, ?)',
+                               (str(userid), ujson.dumps(account)))
+
+    def put_many(self, accounts):
+        """Replaces a number of accounts in a single transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO accounts (userid, account) VALUES (?, ?)',
+                                   [(str(userid), ujson.dumps(account)) for userid, account in accounts])
+
+
+def _atomic_dump(path, data):
+    """Writes JSON to a file without it ever being half-written."""
+    _atomic_write(path, ujson.dumps(data).encode())
+
+
+def _atomic_write(path, data):
+    """Writes bytes to a temporary file and renames it over the destination, so the file is never half-written."""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _decode_json(data):
+    """Decodes accounts from JSON."""
+    accounts = ujson.loads(data)
+    for account in accounts.values():
+        _load_inventory(account)
+    return accounts
+
+
+def _decode_msgpack(data):
+    """Converts msgpack-encoded accounts back into the same accounts that loading users.json would give."""
+    accounts = {}
+    for userid, account in msgpack.unpackb(data, strict_map_key=False).items():
+        inventory = account.get(ITEMS_KEY)
+        if isinstance(inventory, list):
+            account[ITEMS_KEY] = Inventory(*inventory)
+        if isinstance(account.get(QUESTS_KEY), int):
+            account[QUESTS_KEY] = hex(account[QUESTS_KEY])
+        accounts[str(userid)] = account
+    return accounts
+
+
+def _diff_account(old, new):
+    """Creates a journal record of the fields that differ between two versions of an account, or returns None if
+    they are the same. Inventory items are recorded individually, with a count of 0 meaning the item was removed."""
+    if old is None:
+        old = {}
+    record = {}
+    changed = {key: value for key, value in new.items() if key != ITEMS_KEY and old.get(key) != value}
+    if changed:
+        record['set'] = changed
+    old_items = old.get(ITEMS_KEY, {})
+    new_items = new.get(ITEMS_KEY, {})
+    items = {itemid: new_items.get(itemid, 0) for itemid in set(old_items) | set(new_items)
+             if new_items.get(itemid, 0) != old_items.get(itemid, 0)}
+    if items:
+        record[ITEMS_KEY] = items
+    return record or None
+
+
+def _encode_msgpack(accounts):
+    """Encodes accounts with msgpack. User ids are stored as ints, inventories as a list of item ids and a list of
+    how many of each there are, and completed quests as an int instead of a hex string. User ids and quests that would
+    not convert back to exactly the same string are left as they are."""
+    if msgpack is None:
+        raise ImportError('The msgpack account format requires the msgpack package.')
+    packed = {}
+    for userid, account in accounts.items():
+        account = dict(account)
+        inventory = account.get(ITEMS_KEY)
+        if inventory is not None:
+            if not isinstance(inventory, Inventory):
+                inventory = Inventory.from_dict(inventory)
+            account[ITEMS_KEY] = [inventory.keys(), inventory.values()]
+        quests = account.get(QUESTS_KEY)
+        if isinstance(quests, str) and quests.startswith('0x') and hex(int(quests, 16)) == quests:
+            account[QUESTS_KEY] = int(quests, 16)
+        userids = _to_ints([userid])
+        packed[userid if userids is None else userids[0]] = account
+    return msgpack.packb(packed)
+
+
+def _file_stat(path):
+    """Gets the (mtime, size) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _load_inventory(account):
+    """Converts the inventory of an account decoded from JSON into an Inventory."""
+    if ITEMS_KEY in account:
+        account[ITEMS_KEY] = Inventory.from_dict(account[ITEMS_KEY])
+    return account
+
+
+def _to_ints(ids):
+    """Converts a list of string ids to ints, or returns None if str() would not give back exactly the same list."""
+    try:
+        ints = list(map(int, ids))
+    except (TypeError, ValueError):
+        return None
+    return ints if list(map(str, ints)) == ids else None
+
+
+CODECS = {
+    'json': (ujson.loads, lambda accounts: ujson.dumps(accounts).encode()),
+    'msgpack': (_decode_msgpack, _encode_msgpack)
+}
+
+BACKENDS = {
+    'json': lambda: FileStore(USERS_JSON),
+    'msgpack': lambda: FileStore(USERS_MSGPACK, codec='msgpack'),
+    'sqlite': lambda: SqliteStore(USERS_DB),
+    'journal': lambda: JournalStore(USERS_JSON, USERS_JOURNAL),
+    'sharded': lambda: ShardedStore(USERS_DIRECTORY)
+}
+
+
+def convert(source, destination, source_codec='json', destination_codec='msgpack'):
+    """Rewrites an accounts file in a different format and returns the number of accounts converted."""
+    accounts = dict(FileStore(source, codec=source_codec).items())
+    _atomic_write(destination, CODECS[destination_codec][1](accounts))
+    return len(accounts)
+
+
+def flush():
+    """Writes out any account changes the store is holding back."""
+    if _STORE['store'] is not None:
+        _STORE['store'].flush()
+
+
+def get_store():
+    """Gets the store selected by USERS_BACKEND, opening it the first time it is used."""
+    if _STORE['store'] is None:
+        _STORE['store'] = BACKENDS[USERS_BACKEND]()
+    return _STORE['store']
+
+
+def import_json(path=USERS_JSON, db_path=USERS_DB):
+    """Copies every account in a JSON accounts file into an SQLite database and returns the number copied."""
+    accounts = FileStore(path).items()
+    SqliteStore(db_path).put_many(accounts)
+    return len(accounts)
+
+
+def shard_json(path=USERS_JSON, directory=USERS_DIRECTORY):
+    """Copies every account in a JSON accounts file into a sharded store and returns the number copied."""
+    accounts = FileStore(path).items()
+    ShardedStore(directory).put_many(accounts)
+    return len(accounts)
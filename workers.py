@@ -0,0 +1,58 @@
+"""This module contains the pools of worker processes and threads that game work is run in so that it does not hold up
+the event loop. CPU-heavy work, such as rolling loot, is run in processes, and work that reads or writes the game files
+is run in threads."""
+import asyncio
+import concurrent.futures
+import functools
+
+from subs.miniscape.files import GAME_THREADS, WORKER_PROCESSES
+
+_POOL = {'pool': None, 'broken': False}
+_THREADS = {'pool': None}
+
+
+def get_pool():
+    """Gets the process pool, starting it the first time it is used. Returns None if WORKER_PROCESSES is 0 or worker
+    processes cannot be used here."""
+    if _POOL['pool'] is None and not _POOL['broken'] and WORKER_PROCESSES > 0:
+        try:
+            _POOL['pool'] = concurrent.futures.ProcessPoolExecutor(WORKER_PROCESSES)
+        except (ImportError, NotImplementedError, OSError) as e:
+            print(f'Could not start worker processes, so work will be run in this process: {e!r}')
+            _POOL['broken'] = True
+    return _POOL['pool']
+
+
+async def run(func, *args, **kwargs):
+    """Runs a function in a worker process and returns its result. If there is no pool, or it has broken, the
+    function is run in a thread of this process instead. The function and its arguments are sent to the worker by
+    pickling, so it has to be a module-level function, and it must not read or change the account or adventure files,
+    as those are only kept up to date in this process."""
+    loop = asyncio.get_event_loop()
+    call = functools.partial(func, *args, **kwargs)
+    pool = get_pool()
+    if pool is not None:
+        try:
+            return await loop.run_in_executor(pool, call)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            print(f'Worker processes have stopped, so work will be run in this process: {e!r}')
+            _POOL['pool'] = None
+            _POOL['broken'] = True
+    return await loop.run_in_executor(None, call)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Runs a function in one of the game threads and returns its result. These are kept apart from the event loop's
+    default executor, which discord.py also uses, so a burst of slow commands cannot hold up the bot's own work."""
+    if _THREADS['pool'] is None:
+        _THREADS['pool'] = concurrent.futures.ThreadPoolExecutor(GAME_THREADS, thread_name_prefix='miniscape')
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_THREADS['pool'], functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """Stops the worker processes and threads, if they were started."""
+    for pool in (_POOL, _THREADS):
+        if pool['pool'] is not None:
+            pool['pool'].shutdown()
+            pool['pool'] = None